@@ -127,9 +127,12 @@ import re
 import shutil
 import datetime
 import random
+import time
+import multiprocessing
 import urllib.parse
 import urllib.request
 from pathlib import Path, PureWindowsPath
+from concurrent.futures import ThreadPoolExecutor
 import xml.etree.cElementTree as ET
 import psutil
 
@@ -358,11 +361,17 @@ def findModsPath(installPath=None):
     return modsPath
 
 
-def loadMods(autogenerate, installPath, resourcePath):
+# kept next to settings.ini, out of resources so writing it doesn't invalidate it
+LOOKUP_SNAPSHOT_PATH = "LookupSnapshot.bin"
+
+
+def loadMods(autogenerate, installPath, resourcePath, modsPath=None, lazy=False):
     global xmlLookups
 
     # Each mod in the mod folder is a Group
-    modsPath = findModsPath(installPath)
+    if modsPath is None:
+        modsPath = findModsPath(installPath)
+    xmlLookups.addSource(modsPath)
     if not os.path.isdir(modsPath):
         printf("Could not find Mods Folder! Skipping mod content!")
         return
@@ -373,11 +382,11 @@ def loadMods(autogenerate, installPath, resourcePath):
     if autogenerate and not os.path.exists(autogenPath):
         os.mkdir(autogenPath)
 
-    printSectionBreak()
-    printf("LOADING MOD CONTENT")
+    mods = []
     for mod in modsInstalled:
         modPath = os.path.join(modsPath, mod)
         brPath = os.path.join(modPath, "basementrenovator")
+        xmlLookups.addSource(modPath)
 
         # Make sure we're a mod
         if not os.path.isdir(modPath) or os.path.isfile(
@@ -389,19 +398,47 @@ def loadMods(autogenerate, installPath, resourcePath):
         if not (autogenerate or os.path.exists(brPath)):
             continue
 
+        xmlLookups.addSource(os.path.join(modPath, "metadata.xml"))
+        mods.append((mod, modPath, brPath))
+
+    def parseMod(mod, modPath, brPath):
+        start = time.perf_counter()
+
         # Get the mod name
-        modName = mod
+        modName, metadataFailed = mod, False
         try:
             tree = ET.parse(os.path.join(modPath, "metadata.xml"))
             root = tree.getroot()
             modName = root.find("name").text
         except ET.ParseError:
+            metadataFailed = True
+
+        parsedFiles = MainLookup.parseModFiles(modPath, brPath)
+        return modName, metadataFailed, parsedFiles, time.perf_counter() - start
+
+    printSectionBreak()
+    printf("LOADING MOD CONTENT")
+
+    # parse every mod's files up front on worker threads, then apply them in
+    # folder order since later mods can override earlier ones
+    with ThreadPoolExecutor() as pool:
+        futures = [pool.submit(parseMod, *args) for args in mods]
+        for (mod, modPath, brPath), future in zip(mods, futures):
+            modName, metadataFailed, parsedFiles, parseTime = future.result()
+            if metadataFailed:
+                printf(
+                    f'Failed to parse mod metadata "{mod}", falling back on default name'
+                )
+
+            start = time.perf_counter()
+            xmlLookups.loadFromMod(
+                modPath, brPath, modName, autogenerate, parsedFiles, lazy
+            )
+            loadTime = time.perf_counter() - start
             printf(
-                f'Failed to parse mod metadata "{modName}", falling back on default name'
+                f'Loaded "{modName}" in {parseTime + loadTime:.3f}s ({parseTime:.3f}s parsing)'
             )
 
-        xmlLookups.loadFromMod(modPath, brPath, modName, autogenerate)
-
 
 ########################
 #      Scene/View      #
@@ -2447,7 +2484,11 @@ class Room(QListWidgetItem):
                 printf(f"{name} ({variant}): Invalid doors!", doors)
             self.info.doors = doors
 
-        self.gridSpawns = spawns or [[] for x in range(self.info.gridLen())]
+        if spawns:
+            self.gridSpawns = spawns
+        else:
+            self._gridSpawns = [[] for x in range(self.info.gridLen())]
+            self._spawnCount = 0
         if self.info.gridLen() != len(self.gridSpawns):
             printf(f"{name} ({variant}): Invalid grid spawns!")
 
@@ -2524,6 +2565,26 @@ class Room(QListWidgetItem):
         for door in self.info.doors:
             d = Door(door)
 
+    def addStack(self, idx, stack):
+        """Adds entities to the stack at a grid index, keeping the spawn count in sync"""
+        if not stack:
+            return
+
+        gridStack = self._gridSpawns[idx]
+        if not gridStack:
+            self._spawnCount += 1
+
+        gridStack.extend(stack)
+
+    def removeStack(self, idx):
+        """Empties the stack at a grid index, returning the entities that were in it"""
+        stack = self._gridSpawns[idx]
+        if stack:
+            self._spawnCount -= 1
+            self._gridSpawns[idx] = []
+
+        return stack
+
     def getSpawnCount(self):
         return self._spawnCount
 
@@ -2537,13 +2598,17 @@ class Room(QListWidgetItem):
 
         gridLen = self.info.gridLen()
         newGridSpawns = [[] for x in range(gridLen)]
+        spawnCount = 0
 
         for stack, x, y in spawnIter:
             idx = Room.Info.gridIndex(x, y, realWidth)
             if idx < gridLen:
+                if not newGridSpawns[idx]:
+                    spawnCount += 1
                 newGridSpawns[idx] = stack
 
-        self.gridSpawns = newGridSpawns
+        self._gridSpawns = newGridSpawns
+        self._spawnCount = spawnCount
 
     def getDesc(self):
         return RoomData.getDesc(self.info, self.name, self.difficulty, self.weight)
@@ -3280,6 +3345,17 @@ class RoomSelector(QWidget):
     def changeFilter(self):
         self.colorizeClearFilterButtons()
 
+        # tags are resolved to masks once, so each entity check is a single AND
+        checkTags = ["InEmptyRooms"]
+        if settings.value("NonCombatRoomFilter") == "1":
+            checkTags.append("InNonCombatRooms")
+        emptyRoomTagMask = xmlLookups.entities.getTagMask(checkTags, matchAnyTag=True)
+
+        tagsData = self.filter.extraData["tags"]
+        matchAnyTag = tagsData["mode"] == "Any" or tagsData["mode"] == "Blacklist"
+        checkUnmatched = tagsData["mode"] == "Exclusive"
+        filterTagMask = xmlLookups.entities.getTagMask(tagsData["tags"], matchAnyTag)
+
         # Here we go
         for room in self.getRooms():
             IDCond = entityCond = typeCond = sizeCond = extraCond = True
@@ -3297,13 +3373,8 @@ class RoomSelector(QWidget):
 
                 # For null rooms, include "empty" rooms regardless of type
                 if not typeCond and self.filter.typeData == 0:
-                    nonCombatRooms = settings.value("NonCombatRoomFilter") == "1"
-                    checkTags = ["InEmptyRooms"]
-                    if nonCombatRooms:
-                        checkTags.append("InNonCombatRooms")
-
                     hasUsefulEntities = any(
-                        not config.matches(tags=checkTags, matchAnyTag=True)
+                        not config.matchesTagMask(emptyRoomTagMask, matchAnyTag=True)
                         for config in room.palette.values()
                     )
 
@@ -3370,16 +3441,9 @@ class RoomSelector(QWidget):
                         )
 
                 # Check if the room contains entities with certain tags
-                tagsData = self.filter.extraData["tags"]
                 if extraCond and tagsData["enabled"]:
-                    checkTags = tagsData["tags"]
-                    matchAnyTag = (
-                        tagsData["mode"] == "Any" or tagsData["mode"] == "Blacklist"
-                    )
-                    checkUnmatched = tagsData["mode"] == "Exclusive"
-
                     matched = any(
-                        config.matches(tags=checkTags, matchAnyTag=matchAnyTag)
+                        config.matchesTagMask(filterTagMask, matchAnyTag=matchAnyTag)
                         != checkUnmatched
                         for config in room.palette.values()
                     )
@@ -3833,11 +3897,20 @@ class EntityItem(QStandardItem):
         self.ID = config.type
         self.variant = config.variant
         self.subtype = config.subtype
-        self.icon = anm2.loadIcon(config.imagePath)
         self.config = config
+        self._icon = None
 
         self.setToolTip(self.name)
 
+    @property
+    def icon(self):
+        # lazily loaded mod entities only check their images once they're shown
+        if self._icon is None:
+            self.config.resolve()
+            self._icon = anm2.loadIcon(self.config.imagePath)
+
+        return self._icon
+
 
 class EntityGroupModel(QAbstractListModel):
     """Model containing all the grouped objects in a tileset"""
@@ -5448,6 +5521,9 @@ class MainWindow(QMainWindow):
         self.fk = f.addAction(
             "Export to STB (Rebirth)", lambda: self.exportSTB(stbType="Rebirth")
         )
+        self.fk = f.addAction(
+            "Export to STB (Antibirth)", lambda: self.exportSTB(stbType="Antibirth")
+        )
         f.addSeparator()
         self.fk = f.addAction(
             "Copy Screenshot to Clipboard",
@@ -6072,6 +6148,70 @@ class MainWindow(QMainWindow):
         if not isXml:
             self.saveMap()
 
+    def coreToRoomItem(self, coreRoom):
+        """Converts a room read by roomconvert into an editor room"""
+        palette = {}
+        gridSpawns = []
+        global xmlLookups
+        for gridSpawn in coreRoom.gridSpawns:
+            spawns = []
+            for spawn in gridSpawn:
+                spawns.append([spawn.Type, spawn.Variant, spawn.Subtype, spawn.weight])
+
+                config = xmlLookups.entities.lookupOne(
+                    spawn.Type, spawn.Variant, spawn.Subtype
+                )
+                if config and config.uniqueid not in palette:
+                    palette[config.uniqueid] = config
+
+            gridSpawns.append(spawns)
+
+        r = Room(
+            coreRoom.name,
+            gridSpawns,
+            palette,
+            coreRoom.difficulty,
+            coreRoom.weight,
+            coreRoom.info.type,
+            coreRoom.info.variant,
+            coreRoom.info.subtype,
+            coreRoom.info.shape,
+            coreRoom.info.doors,
+        )
+        r.xmlProps = dict(coreRoom.xmlProps)
+        r.lastTestTime = coreRoom.lastTestTime
+        return r
+
+    def roomItemToCore(self, room):
+        """Converts an editor room into one roomconvert can write"""
+
+        def entItemToCore(e, i, w):
+            x = i % w
+            y = int(i / w)
+            return EntityData(x, y, e[0], e[1], e[2], e[3])
+
+        realWidth = room.info.dims[0]
+        spawns = list(
+            map(
+                lambda s: list(map(lambda e: entItemToCore(e, s[0], realWidth), s[1])),
+                enumerate(room.gridSpawns),
+            )
+        )
+        r = RoomData(
+            room.name,
+            spawns,
+            room.difficulty,
+            room.weight,
+            room.info.type,
+            room.info.variant,
+            room.info.subtype,
+            room.info.shape,
+            room.info.doors,
+        )
+        r.xmlProps = dict(room.xmlProps)
+        r.lastTestTime = room.lastTestTime
+        return r
+
     def open(self, path=None, addToRecent=True):
         path = path or self.path
         roomFile = None
@@ -6125,42 +6265,7 @@ class MainWindow(QMainWindow):
                             config is None or config.invalid
                         )
 
-        def coreToRoomItem(coreRoom):
-            palette = {}
-            gridSpawns = []
-            global xmlLookups
-            for gridSpawn in coreRoom.gridSpawns:
-                spawns = []
-                for spawn in gridSpawn:
-                    spawns.append(
-                        [spawn.Type, spawn.Variant, spawn.Subtype, spawn.weight]
-                    )
-
-                    config = xmlLookups.entities.lookupOne(
-                        spawn.Type, spawn.Variant, spawn.Subtype
-                    )
-                    if config and config.uniqueid not in palette:
-                        palette[config.uniqueid] = config
-
-                gridSpawns.append(spawns)
-
-            r = Room(
-                coreRoom.name,
-                gridSpawns,
-                palette,
-                coreRoom.difficulty,
-                coreRoom.weight,
-                coreRoom.info.type,
-                coreRoom.info.variant,
-                coreRoom.info.subtype,
-                coreRoom.info.shape,
-                coreRoom.info.doors,
-            )
-            r.xmlProps = dict(coreRoom.xmlProps)
-            r.lastTestTime = coreRoom.lastTestTime
-            return r
-
-        roomFile.rooms = list(map(coreToRoomItem, rooms))
+        roomFile.rooms = list(map(self.coreToRoomItem, rooms))
 
         # Update recent files
         if (
@@ -6241,37 +6346,7 @@ class MainWindow(QMainWindow):
 
         self.storeEntityList()
 
-        def entItemToCore(e, i, w):
-            x = i % w
-            y = int(i / w)
-            return EntityData(x, y, e[0], e[1], e[2], e[3])
-
-        def roomItemToCore(room):
-            realWidth = room.info.dims[0]
-            spawns = list(
-                map(
-                    lambda s: list(
-                        map(lambda e: entItemToCore(e, s[0], realWidth), s[1])
-                    ),
-                    enumerate(room.gridSpawns),
-                )
-            )
-            r = RoomData(
-                room.name,
-                spawns,
-                room.difficulty,
-                room.weight,
-                room.info.type,
-                room.info.variant,
-                room.info.subtype,
-                room.info.shape,
-                room.info.doors,
-            )
-            r.xmlProps = dict(room.xmlProps)
-            r.lastTestTime = room.lastTestTime
-            return r
-
-        rooms = list(map(roomItemToCore, rooms))
+        rooms = list(map(self.roomItemToCore, rooms))
 
         ext = os.path.splitext(path)[1]
         if ext == ".xml":
@@ -6279,6 +6354,8 @@ class MainWindow(QMainWindow):
         else:
             if stbType == "Rebirth":
                 StageConvert.commonToSTBRB(path, rooms)  # cspell:disable-line
+            elif stbType == "Antibirth":
+                StageConvert.commonToSTBAnti(path, rooms)  # cspell:disable-line
             else:
                 StageConvert.commonToSTBAB(path, rooms)  # cspell:disable-line
 
@@ -6644,25 +6721,34 @@ class MainWindow(QMainWindow):
                 )
                 raise
 
-            startRoom = None
-            roomFile = self.open(roomPath, False)
-            for room in roomFile.rooms:
-                if "Start Room" in room.name:
-                    room.info.shape = testRoom.info.shape
-                    room.gridSpawns = testRoom.gridSpawns
-                    startRoom = room
-                    break
+            # only the start room is decoded, the rest are copied over untouched
+            roomIndex = StageConvert.stbRoomIndex(roomPath)
+            stbFormat, entries = roomIndex
+            startEntry = next(
+                (i for i, entry in enumerate(entries) if "Start Room" in entry[3]),
+                None,
+            )
 
-            if not startRoom:
+            if startEntry is None:
                 QMessageBox.warning(
                     self, "Error", "00.special rooms.stb is not a valid STB file."
                 )
                 raise
 
+            self.storeEntityList()
+
+            startRoom = self.coreToRoomItem(
+                StageConvert.stbReadRoom(roomPath, stbFormat, entries[startEntry])
+            )
+            startRoom.info.shape = testRoom.info.shape
+            startRoom.gridSpawns = testRoom.gridSpawns
+
             path = os.path.join(roomsPath, "00.special rooms.stb")
 
             # Resave the file
-            self.save(roomFile.rooms, path, updateRecent=False)
+            StageConvert.stbReplaceRooms(
+                roomPath, path, {startEntry: self.roomItemToCore(startRoom)}, roomIndex
+            )
 
             return [], [startRoom], ""
 
@@ -7185,6 +7271,9 @@ def applyDefaultSettings(settings, defaults):
 
 
 if __name__ == "__main__":
+    # icon rendering starts worker processes, which frozen builds have to hand off here
+    multiprocessing.freeze_support()
+
     import sys
 
     min_version = [3, 7]
@@ -7221,13 +7310,36 @@ if __name__ == "__main__":
 
     # XML Globals
     version = getGameVersion()
-    xmlLookups = MainLookup(version, settings.value("Verbose") == "1")
-    if settings.value("DisableMods") != "1":
-        loadMods(
-            settings.value("ModAutogen") == "1",
-            findInstallPath(),
-            settings.value("ResourceFolder", ""),
-        )
+    verbose = settings.value("Verbose") == "1"
+    autogenerate = settings.value("ModAutogen") == "1"
+    lazyMods = settings.value("LazyModLoading") == "1"
+    installPath = findInstallPath()
+    modsPath = (
+        findModsPath(installPath) if settings.value("DisableMods") != "1" else None
+    )
+
+    # reuse the lookups from the last launch if nothing they were loaded from changed
+    useSnapshot = settings.value("DisableLookupSnapshot") != "1"
+    snapshotOptions = (version, verbose, autogenerate, lazyMods, modsPath)
+    xmlLookups = None
+    if useSnapshot:
+        xmlLookups = MainLookup.loadSnapshot(LOOKUP_SNAPSHOT_PATH, snapshotOptions)
+        if xmlLookups is not None:
+            printf("Loaded entities, stages and room types from snapshot")
+
+    if xmlLookups is None:
+        xmlLookups = MainLookup(version, verbose)
+        if modsPath is not None:
+            loadMods(
+                autogenerate,
+                installPath,
+                settings.value("ResourceFolder", ""),
+                modsPath,
+                lazyMods,
+            )
+
+        if useSnapshot:
+            xmlLookups.saveSnapshot(LOOKUP_SNAPSHOT_PATH, snapshotOptions)
 
     printf("-".join(["" for i in range(50)]))
     printf("INITIALIZING MAIN WINDOW")
@@ -65,6 +65,17 @@ class Config:
 
         self.useScaling = True
 
+    def resolveSpritesheet(self, sheetPath):
+        """Finds a spritesheet next to the anm2, falling back on the resource folder"""
+        image = os.path.abspath(os.path.join(self.dir, sheetPath))
+        imgPath = Path(image)
+        if not (imgPath and imgPath.exists()):
+            image = re.sub(r".*resources", self.resourcePath, image)
+            imgPath = Path(image)
+            image = str(imgPath) if imgPath.exists() else None
+
+        return image
+
     def getAnim(self, name):
         if not name:
             return None
@@ -116,16 +127,10 @@ class Config:
 
             image = self.spritesheets[self.layers[int(layer.get("LayerId"))]] or ""
 
-            imgPath = None
             sheetPath = None
             if isinstance(image, str):
                 sheetPath = image
-                image = os.path.abspath(os.path.join(self.dir, image))
-                imgPath = Path(image)
-                if not (imgPath and imgPath.exists()):
-                    image = re.sub(r".*resources", self.resourcePath, image)
-                    imgPath = Path(image)
-                    image = str(imgPath) if imgPath.exists() else None
+                image = self.resolveSpritesheet(image)
 
             if image is not None:
                 # Here's the anm specs
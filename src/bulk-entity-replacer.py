@@ -2,25 +2,49 @@
 Bulk replaces entities across room files
 """
 
-import json
+import json, re
 from pathlib import Path
 from PyQt5.QtCore import QCommandLineOption, QCommandLineParser
 from PyQt5.QtWidgets import QApplication
 
 import roomconvert as cvt
-from util import printf
+from util import printf, runJobs
 
 
-def replaceEntities(rooms, replaced, replacement):
-    numEnts = 0
-    numRooms = 0
+def compileRules(entityPairs):
+    """
+    Indexes the replacement rules by the type, variant and subtype they replace, with -1
+    for wild cards, so each entity can be checked against every rule in a few lookups
+    """
+    ruleTable = {}
+    for i, entPair in enumerate(entityPairs):
+        t, v, s = entPair["from"]
+        ruleTable.setdefault((t, max(v, -1), max(s, -1)), []).append(i)
 
-    def checkEq(ent, b):
-        return (
-            ent.Type == b[0]
-            and (b[1] < 0 or ent.Variant == b[1])
-            and (b[2] < 0 or ent.Subtype == b[2])
-        )
+    return ruleTable
+
+
+def matchRule(ruleTable, t, v, s, after=-1):
+    """Returns the index of the first rule after the given one that replaces the entity"""
+    match = None
+    for key in ((t, v, s), (t, v, -1), (t, -1, s), (t, -1, -1)):
+        for i in ruleTable.get(key, ()):
+            if i > after:
+                if match is None or i < match:
+                    match = i
+                break
+
+    return match
+
+
+def replaceEntities(rooms, entityPairs, ruleTable):
+    """
+    Applies the rules to every entity in one pass; rules still apply in order, so an
+    entity replaced by one rule can be replaced again by a later one. Returns how many
+    entities and rooms each rule replaced in
+    """
+    numEnts = [0] * len(entityPairs)
+    numRooms = [0] * len(entityPairs)
 
     def fixEnt(ent, b):
         ent.Type = b[0]
@@ -30,27 +54,70 @@ def replaceEntities(rooms, replaced, replacement):
             ent.Subtype = b[2]
 
     for currRoom in rooms:
-        n = 0
+        roomRules = set()
         for stack, x, y in currRoom.spawns():
             for ent in stack:
-                if checkEq(ent, replaced):
-                    fixEnt(ent, replacement)
-                    n += 1
-
-        if n > 0:
-            numRooms += 1
-            numEnts += n
-
-    printf(
-        f"{replaced} -> {replacement}: "
-        + (
-            numEnts > 0
-            and f"Replaced {numEnts} entities in {numRooms} rooms"
-            or "No entities to replace!"
+                i = matchRule(ruleTable, ent.Type, ent.Variant, ent.Subtype)
+                while i is not None:
+                    fixEnt(ent, entityPairs[i]["to"])
+                    numEnts[i] += 1
+                    roomRules.add(i)
+                    i = matchRule(ruleTable, ent.Type, ent.Variant, ent.Subtype, i)
+
+        for i in roomRules:
+            numRooms[i] += 1
+
+    return numEnts, numRooms
+
+
+def printRuleCounts(entityPairs, numEnts, numRooms, dryRun=False):
+    verb = dryRun and "Would replace" or "Replaced"
+    for entPair, ruleEnts, ruleRooms in zip(entityPairs, numEnts, numRooms):
+        printf(
+            f"{entPair['from']} -> {entPair['to']}: "
+            + (
+                ruleEnts > 0
+                and f"{verb} {ruleEnts} entities in {ruleRooms} rooms"
+                or "No entities to replace!"
+            )
         )
+
+
+def compileTypeFilter(entityPairs):
+    """
+    Builds a pattern matching the type attribute of any entity a rule replaces, for
+    skipping files without parsing them
+    """
+    types = sorted({str(entPair["from"][0]) for entPair in entityPairs})
+    return re.compile(
+        rb"\btype\s*=\s*[\"'](?:"
+        + b"|".join(re.escape(t.encode()) for t in types)
+        + rb")[\"']"
     )
 
-    return numEnts
+
+def mayNeedReplacing(path, typeFilter):
+    """Cheaply checks whether an xml could contain an entity any rule replaces"""
+    with open(path, "rb") as f:
+        return typeFilter.search(f.read()) is not None
+
+
+def replaceFileEntities(path, entityPairs, ruleTable, saveSTB=False, dryRun=False):
+    """
+    Replaces entities in a single xml room file, saving it and optionally an stb next to
+    it if anything changed. Returns the room count and each rule's entity and room counts
+    """
+    roomFile = cvt.xmlToCommon(path)
+    rooms = roomFile.rooms
+
+    numEnts, numRooms = replaceEntities(rooms, entityPairs, ruleTable)
+
+    if sum(numEnts) > 0 and not dryRun:
+        cvt.commonToXML(path, rooms, file=roomFile)
+        if saveSTB:
+            cvt.commonToSTBAB(path.with_suffix(".stb"), rooms)
+
+    return len(rooms), numEnts, numRooms
 
 
 def recurseGetFiles(path: Path):
@@ -97,6 +164,19 @@ if __name__ == "__main__":
     )
     cmdParser.addOption(stbOpt)
 
+    jobsOpt = QCommandLineOption(
+        "jobs",
+        "number of processes to replace entities with; 0 uses one per core",
+        "n",
+        "1",
+    )
+    cmdParser.addOption(jobsOpt)
+
+    dryRunOpt = QCommandLineOption(
+        "dry-run", "report what would be replaced without saving any files"
+    )
+    cmdParser.addOption(dryRunOpt)
+
     cmdParser.process(app)
 
     args = cmdParser.positionalArguments()
@@ -109,6 +189,13 @@ if __name__ == "__main__":
     workingDirectory = configPath.parent
 
     stbArg = cmdParser.isSet(stbOpt)
+    dryRun = cmdParser.isSet(dryRunOpt)
+
+    jobsArg = cmdParser.value(jobsOpt)
+    if not jobsArg.isdigit():
+        printf("Jobs must be a whole number!")
+        sys.exit()
+    jobs = int(jobsArg)
 
     with open(configPath) as configFile:
         config = json.load(configFile)
@@ -117,7 +204,12 @@ if __name__ == "__main__":
             stbArg = True
 
         totalRooms = 0
-        printf("Replacing entities:", config["entities"])
+        entityPairs = config["entities"]
+        printf("Replacing entities:", entityPairs)
+
+        ruleTable = compileRules(entityPairs)
+        totalEnts = [0] * len(entityPairs)
+        totalEntRooms = [0] * len(entityPairs)
 
         files = []
         for file in config["files"]:
@@ -127,22 +219,39 @@ if __name__ == "__main__":
             else:
                 printf(f"{basePath} is not an XML file or directory, skipping!")
 
+        typeFilter = compileTypeFilter(entityPairs)
+
+        toReplace = []
         for path in files:
+            if mayNeedReplacing(path, typeFilter):
+                toReplace.append(path)
+            else:
+                printf("No entities to replace, skipping file:", path)
+
+        results = runJobs(
+            replaceFileEntities,
+            [(path, entityPairs, ruleTable, stbArg, dryRun) for path in toReplace],
+            jobs,
+        )
+
+        for path, (result, error) in zip(toReplace, results):
             printf("Replacing Entities in File: ", path)
+            if error:
+                printf("Failed replacing entities! Reason:", repr(error))
+                continue
 
-            roomFile = cvt.xmlToCommon(path)
-            rooms = roomFile.rooms
+            roomCount, numEnts, numRooms = result
+            printf("Room Count:", roomCount)
+            totalRooms += roomCount
 
-            printf("Room Count:", len(rooms))
-            totalRooms += len(rooms)
+            printRuleCounts(entityPairs, numEnts, numRooms, dryRun)
 
-            numEnts = 0
-            for entPair in config["entities"]:
-                numEnts += replaceEntities(rooms, entPair["from"], entPair["to"])
+            for i in range(len(entityPairs)):
+                totalEnts[i] += numEnts[i]
+                totalEntRooms[i] += numRooms[i]
 
-            if numEnts > 0:
-                cvt.commonToXML(path, rooms, file=roomFile)
-                if stbArg:
-                    cvt.commonToSTBAB(path.with_suffix(".stb"), rooms)
+        printf("----")
+        printf("Totals:")
+        printRuleCounts(entityPairs, totalEnts, totalEntRooms, dryRun)
 
     printf("Success!", totalRooms, "affected")
@@ -338,7 +338,11 @@ class Room:
                 printf(f"{name} ({variant}): Invalid doors!", doors)
             self.info.doors = doors
 
-        self.gridSpawns = spawns or [[] for x in range(self.info.gridLen())]
+        if spawns:
+            self.gridSpawns = spawns
+        else:
+            self._gridSpawns = [[] for x in range(self.info.gridLen())]
+            self._spawnCount = 0
         if self.info.gridLen() != len(self.gridSpawns):
             printf(f"{name} ({variant}): Invalid grid spawns!")
 
@@ -361,6 +365,26 @@ class Room:
             if entStack:
                 self._spawnCount += 1
 
+    def addStack(self, idx, stack):
+        """Adds entities to the stack at a grid index, keeping the spawn count in sync"""
+        if not stack:
+            return
+
+        gridStack = self._gridSpawns[idx]
+        if not gridStack:
+            self._spawnCount += 1
+
+        gridStack.extend(stack)
+
+    def removeStack(self, idx):
+        """Empties the stack at a grid index, returning the entities that were in it"""
+        stack = self._gridSpawns[idx]
+        if stack:
+            self._spawnCount -= 1
+            self._gridSpawns[idx] = []
+
+        return stack
+
     DoorSortKey = lambda door: (door[0], door[1])
 
     def getSpawnCount(self):
@@ -376,13 +400,17 @@ class Room:
 
         gridLen = self.info.gridLen()
         newGridSpawns = [[] for x in range(gridLen)]
+        spawnCount = 0
 
         for stack, x, y in spawnIter:
             idx = Room.Info.gridIndex(x, y, realWidth)
             if idx < gridLen:
+                if not newGridSpawns[idx]:
+                    spawnCount += 1
                 newGridSpawns[idx] = stack
 
-        self.gridSpawns = newGridSpawns
+        self._gridSpawns = newGridSpawns
+        self._spawnCount = spawnCount
 
     @staticmethod
     def toString(t: int, v: int, s: int, n: str | None = None):
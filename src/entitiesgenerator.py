@@ -1,13 +1,133 @@
 import xml.etree.cElementTree as ET
 from xml.dom import minidom
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import multiprocessing
 import os
 import re
 
+from PyQt5.QtGui import QGuiApplication
+
 import src.anm2 as anm2
-from src.util import linuxPathSensitivityTraining, printf
+from src.util import hashFile, linuxPathSensitivityTraining, printf
+
+# bump whenever icons would render differently from the same anm2 and spritesheets
+ICON_CACHE_VERSION = 1
+
+# icons each render worker needs to make up for the cost of starting it
+MIN_RENDERS_PER_WORKER = 32
+
+# path -> (mtime, size, content hash)
+_fileHashes = {}
+
+
+def _hashFileCached(path):
+    stat = os.stat(path)
+    cached = _fileHashes.get(path)
+    if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+
+    digest = hashFile(path)
+    _fileHashes[path] = (stat.st_mtime_ns, stat.st_size, digest)
+    return digest
+
+
+def iconSources(anmPath, resourcePath):
+    """
+    Returns the spritesheets an anm2 resolves to, which together with the anm2
+    decide what its icon renders as
+    """
+    anim = anm2.Config(anmPath, resourcePath)
+    return [anim.resolveSpritesheet(sheetPath or "") for sheetPath in anim.spritesheets]
+
+
+def iconCacheKey(anmPath, spritesheets):
+    """Hashes an anm2 along with the spritesheets from iconSources"""
+    key = hashlib.sha256(f"{ICON_CACHE_VERSION}:{_hashFileCached(anmPath)}".encode())
+    for image in spritesheets:
+        if image is not None and os.path.isfile(image):
+            key.update(f"|{image}:{_hashFileCached(image)}".encode())
+        else:
+            key.update(f"|{image}:missing".encode())
+
+    return key.hexdigest()
+
+
+_renderApp = None
+
+
+def _initRenderWorker():
+    # worker processes need an app for Qt's image plugins, but nothing to show it on
+    global _renderApp
+    os.environ["QT_QPA_PLATFORM"] = "offscreen"
+    _renderApp = QGuiApplication([])
+
+
+def renderIcon(anmPath, resourcePath, filename):
+    """Renders an anm2's icon to filename, returning whether there was anything to render"""
+    anim = anm2.Config(anmPath, resourcePath)
+    anim.setAnimation()
+    anim.frame = anim.animLen - 1
+    img = anim.render()
+    if not img:
+        return False
+
+    # Save it to a Temp file - better than keeping it in memory for user retrieval purposes?
+    img.save(filename, "PNG")
+    return True
+
+
+def renderIcons(renders):
+    """Calls renderIcon for each set of args, over worker processes when there are many"""
+    workers = min(len(renders) // MIN_RENDERS_PER_WORKER, os.cpu_count() or 1)
+    if workers < 2:
+        return [renderIcon(*render) for render in renders]
+
+    # spawn rather than fork, forking a process with a running Qt app isn't safe
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_initRenderWorker,
+    ) as pool:
+        return list(pool.map(renderIcon, *zip(*renders), chunksize=8))
 
 
-def generateXMLFromEntities2(modPath, modName, entities2Root, resourcePath):
+def loadIconManifest(path):
+    """Returns the icon filename -> {key, rendered} entries saved by the last run"""
+    if not os.path.isfile(path):
+        return {}
+
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+
+        if manifest.get("version") == ICON_CACHE_VERSION:
+            return manifest["icons"]
+    except (OSError, ValueError, KeyError) as e:
+        printf("Ignoring unreadable icon manifest", path, e)
+
+    return {}
+
+
+def saveIconManifest(path, icons):
+    try:
+        with open(path, "w") as f:
+            json.dump({"version": ICON_CACHE_VERSION, "icons": icons}, f, indent=4)
+    except OSError as e:
+        printf("Could not save icon manifest", path, e)
+
+
+def generateXMLFromEntities2(
+    modPath, modName, entities2Root, resourcePath, addSource=None
+):
+    """
+    Writes an entities xml with rendered icons for a mod's entities2.xml, returning
+    its entity nodes. addSource is called with every anm2 and spritesheet the icons
+    depend on, including ones looked for but missing
+    """
+    addSource = addSource or (lambda path: None)
+
     cleanUp = re.compile(r"[^\w\d]")
     outputDir = f"resources/Entities/ModTemp/{cleanUp.sub('', modName)}"
     if not os.path.isdir(outputDir):
@@ -24,6 +144,8 @@ def generateXMLFromEntities2(modPath, modName, entities2Root, resourcePath):
 
     printf(f'-----------------------\nLoading entities from "{modName}"')
 
+    resDir = os.path.join(outputDir, "icons")
+
     def mapEn(en):
         # Fix some shit
         i = int(en.get("id"))
@@ -45,6 +167,8 @@ def generateXMLFromEntities2(modPath, modName, entities2Root, resourcePath):
             or ""
         )
         printf("LOADING:", anmPath)
+        if anmPath:
+            addSource(anmPath)
         if not os.path.isfile(anmPath):
             anmPath = (
                 linuxPathSensitivityTraining(
@@ -54,34 +178,22 @@ def generateXMLFromEntities2(modPath, modName, entities2Root, resourcePath):
             )
 
             printf("REDIRECT LOADING:", anmPath)
+            if anmPath:
+                addSource(anmPath)
             if not os.path.isfile(anmPath):
                 printf("Skipping: Invalid anm2!")
                 return None
 
-        anim = anm2.Config(anmPath, resourcePath)
-        anim.setAnimation()
-        anim.frame = anim.animLen - 1
-        img = anim.render()
-
-        filename = "resources/Entities/questionmark.png"
-        if img:
-            # Save it to a Temp file - better than keeping it in memory for user retrieval purposes?
-            resDir = os.path.join(outputDir, "icons")
-            if not os.path.isdir(resDir):
-                os.mkdir(resDir)
-            filename = os.path.join(
-                resDir, f'{en.get("id")}.{v}.{s} - {en.get("name")}.png'
-            )
-            img.save(filename, "PNG")
-        else:
-            printf(f"Could not render icon for entity {i}.{v}.{s}, anm2 path:", anmPath)
-
         # Write the modded entity to the entityXML temporarily for runtime
         entityTemp = ET.Element("entity")
         entityTemp.set("Name", en.get("name"))
         entityTemp.set("ID", str(i))
         entityTemp.set("Variant", v)
         entityTemp.set("Subtype", s)
+        # swapped for the questionmark below if the icon can't be rendered
+        filename = os.path.join(
+            resDir, f'{en.get("id")}.{v}.{s} - {en.get("name")}.png'
+        )
         entityTemp.set("Image", filename)
 
         def condSet(setName, name):
@@ -109,9 +221,64 @@ def generateXMLFromEntities2(modPath, modName, entities2Root, resourcePath):
         else:
             entityTemp.set("Kind", "Enemies")
 
-        return entityTemp
+        return entityTemp, anmPath, filename
+
+    entries = list(filter(lambda x: x is not None, map(mapEn, enList)))
+
+    # icons are only rendered again when their anm2 or spritesheets changed
+    manifestPath = os.path.join(outputDir, "icons.json")
+    cachedIcons = loadIconManifest(manifestPath)
+    icons = {}
+    keys = {}
+    renders = []
+    renderedEntities = []
+    for entityTemp, anmPath, filename in entries:
+        if filename in icons:
+            continue
+
+        key = keys.get(anmPath)
+        if key is None:
+            spritesheets = iconSources(anmPath, resourcePath)
+            for image in spritesheets:
+                if image is not None:
+                    addSource(image)
+
+            key = keys[anmPath] = iconCacheKey(anmPath, spritesheets)
+
+        cached = cachedIcons.get(filename)
+        if (
+            cached
+            and cached["key"] == key
+            and (not cached["rendered"] or os.path.isfile(filename))
+        ):
+            icons[filename] = cached
+        else:
+            icons[filename] = {"key": key, "rendered": False}
+            renders.append((anmPath, resourcePath, filename))
+            renderedEntities.append(entityTemp)
+
+    if renders:
+        if not os.path.isdir(resDir):
+            os.mkdir(resDir)
+
+        printf(f"Rendering {len(renders)} of {len(entries)} icons")
+        for entityTemp, (anmPath, _, filename), rendered in zip(
+            renderedEntities, renders, renderIcons(renders)
+        ):
+            icons[filename]["rendered"] = rendered
+            if not rendered:
+                i, v, s = (entityTemp.get(a) for a in ("ID", "Variant", "Subtype"))
+                printf(
+                    f"Could not render icon for entity {i}.{v}.{s}, anm2 path:", anmPath
+                )
+
+    saveIconManifest(manifestPath, icons)
 
-    result = list(filter(lambda x: x is not None, map(mapEn, enList)))
+    result = []
+    for entityTemp, anmPath, filename in entries:
+        if not icons[filename]["rendered"]:
+            entityTemp.set("Image", "resources/Entities/questionmark.png")
+        result.append(entityTemp)
 
     outputRoot = ET.Element("data")
     outputRoot.extend(result)
@@ -2,8 +2,11 @@ import xml.etree.cElementTree as ET
 import os
 import abc
 import re
+import pickle
 
+from bisect import insort
 from itertools import zip_longest
+from operator import attrgetter, itemgetter
 from pathlib import PurePath
 
 from src.constants import *
@@ -12,14 +15,29 @@ from src.entitiesgenerator import generateXMLFromEntities2
 from src.util import *
 
 
-def loadXMLFile(path):
+def parseXMLFile(path, parsedFiles=None):
+    """
+    Returns an xml file's root, taking it from parsedFiles if it was already parsed
+    there by MainLookup.parseModFiles
+    """
+    parsed = parsedFiles.pop(os.path.normpath(path), None) if parsedFiles else None
+    if parsed is None:
+        return ET.parse(path).getroot()
+
+    root, error = parsed
+    if error is not None:
+        raise error
+
+    return root
+
+
+def loadXMLFile(path, parsedFiles=None):
     root = None
     if not os.path.isfile(path):
         return None
 
     try:
-        tree = ET.parse(path)
-        root = tree.getroot()
+        root = parseXMLFile(path, parsedFiles)
     except Exception as e:
         printf("Error loading BR xml:", e)
         return
@@ -27,6 +45,29 @@ def loadXMLFile(path):
     return root
 
 
+# bump whenever the pickled lookup layout changes so older snapshots get rebuilt
+LOOKUP_SNAPSHOT_VERSION = 4
+
+
+def _sourceState(path):
+    """Returns the mtime and size of a file or folder, or None if it doesn't exist"""
+    try:
+        pathStat = os.stat(path)
+    except OSError:
+        return None
+
+    return (pathStat.st_mtime_ns, pathStat.st_size)
+
+
+def _changedSource(sources):
+    """Returns the first recorded file or folder whose state differs now, if any"""
+    for source, state in sources.items():
+        if _sourceState(source) != state:
+            return source
+
+    return None
+
+
 def parseCriteria(txt):
     if not txt:
         return None
@@ -100,13 +141,14 @@ class Lookup(metaclass=abc.ABCMeta):
         printSectionBreak()
         printf(f'Loading {self.prefix} from "{mod.name}" at {file}')
         previous = self.count()
-        self.loadXML(loadXMLFile(file), mod, *args)
+        self.loadXML(self.parent.loadXMLFile(file), mod, *args)
         printf(
             f'Successfully loaded {self.count() - previous} new {self.prefix} from "{mod.name}"'
         )
 
     def loadFromMod(self, mod, *args):
         file = os.path.join(mod.resourcePath, self.prefix + "Mod.xml")
+        self.parent.addSource(file)
         if not os.path.isfile(file):
             return
 
@@ -128,6 +170,10 @@ class Lookup(metaclass=abc.ABCMeta):
 class StageLookup(Lookup):
     def __init__(self, version, parent):
         self.xml = None
+        # (lowercased Pattern, stage) in xml order, built on the first path lookup
+        self.patterns = None
+        # path -> stages matching it, see getStagesForPath
+        self.pathCache = {}
         super().__init__("Stages", version)
         self.parent = parent
 
@@ -147,6 +193,11 @@ class StageLookup(Lookup):
             self.xml = root
             initialLoad = True
 
+        # new stages and replaced attributes can change what any path matches
+        self.patterns = None
+        self.pathCache = {}
+        self.parent.roomTypes.clearCache()
+
         def mapStage(stage):
             name = stage.get("Name")
             if name is None:
@@ -213,39 +264,65 @@ class StageLookup(Lookup):
             stages = list(filter(hasBasePath, stages))
 
         if path is not None:
-            stages = list(
-                filter(lambda s: s.get("Pattern").lower() in path.lower(), stages)
-            )
-            # Sort the stages by the index of the last part of the path that they matched with:
-            # "/home/test/basement.xml" -> [home, basement]
-            # "/basement/home/room.xml" -> [basement, home]
-            # "/home/basement/home.xml" -> [basement, home]
-            # Python sorts are stable, so stages that match to the same part will maintain their original (xml) order:
-            # "/home/burning basement.xml" -> [home, basement, burning]
-            pathParts = PurePath(path.lower()).parts
-            stages.sort(
-                key=lambda s: next(
-                    (
-                        index
-                        for index, part in reversed(list(enumerate(pathParts)))
-                        if s.get("Pattern").lower() in part
-                    ),
-                    -1,
-                )
-            )
+            # the other filters keep the path's ordering, so only keep what's left
+            remaining = set(stages)
+            stages = [s for s in self.getStagesForPath(path) if s in remaining]
 
         return stages
 
+    def getStagesForPath(self, path):
+        """
+        Returns the stages whose Pattern is in the path, in the order lookup gives
+        them. Cached per path until more stages are loaded
+        """
+        stages = self.pathCache.get(path)
+        if stages is not None:
+            return stages
+
+        if self.patterns is None:
+            self.patterns = [
+                (s.get("Pattern").lower(), s) for s in self.xml.findall("stage")
+            ]
+
+        lowerPath = path.lower()
+        pathParts = PurePath(lowerPath).parts
+
+        # Sort the stages by the index of the last part of the path that they matched with:
+        # "/home/test/basement.xml" -> [home, basement]
+        # "/basement/home/room.xml" -> [basement, home]
+        # "/home/basement/home.xml" -> [basement, home]
+        # Python sorts are stable, so stages that match to the same part will maintain their original (xml) order:
+        # "/home/burning basement.xml" -> [home, basement, burning]
+        matches = []
+        for pattern, stage in self.patterns:
+            if pattern not in lowerPath:
+                continue
+
+            partIndex = -1
+            for index in range(len(pathParts) - 1, -1, -1):
+                if pattern in pathParts[index]:
+                    partIndex = index
+                    break
+
+            matches.append((partIndex, stage))
+
+        matches.sort(key=itemgetter(0))
+        stages = self.pathCache[path] = tuple(stage for partIndex, stage in matches)
+        return stages
+
     def lookupOne(
         self, path=None, name=None, stage=None, stageType=None, baseGamePath=None
     ) -> ET.Element | None:
-        stages = self.lookup(
-            path=path,
-            name=name,
-            stage=stage,
-            stageType=stageType,
-            baseGamePath=baseGamePath,
-        )
+        if path is not None and not (name or stage or stageType or baseGamePath):
+            stages = self.getStagesForPath(path)
+        else:
+            stages = self.lookup(
+                path=path,
+                name=name,
+                stage=stage,
+                stageType=stageType,
+                baseGamePath=baseGamePath,
+            )
 
         if stages:
             return stages[-1]
@@ -258,11 +335,60 @@ class StageLookup(Lookup):
 
 
 class RoomTypeLookup(Lookup):
+    class Criteria:
+        """The room filters on a room type or Gfx node, parsed once"""
+
+        def __init__(self, node: ET.Element):
+            self.type = node.get("Type")
+            nameRegex = node.get("NameRegex")
+            self.nameRegex = re.compile(nameRegex) if nameRegex else None
+            self.stageName = node.get("StageName")
+            self.id = parseCriteria(node.get("ID"))
+            self.subtype = parseCriteria(node.get("Subtype"))
+
+            # how specific the node is, more specific room types win in getMainType
+            # ID is deliberately left out
+            self.weight = (
+                (1 if self.type is not None else 0)
+                + (10 if nameRegex is not None else 0)
+                + (10 if self.stageName is not None else 0)
+                + (10 if node.get("Subtype") is not None else 0)
+            )
+
+            # most specific first, see getGfx
+            self.gfx = sorted(node.findall("Gfx"), key=lambda g: -len(g.attrib))
+
     def __init__(self, version, parent):
         self.xml: ET.Element | None = None
+        self.clearCache()
         super().__init__("RoomTypes", version)
         self.parent = parent
 
+    def clearCache(self):
+        """Drops parsed criteria and cached results, for when room types or stages change"""
+        self.criteria = {}
+        self.mainTypeCache = {}
+        self.gfxCache = {}
+
+    def __getstate__(self):
+        # parsed criteria hold lambdas, which can't be pickled into snapshots
+        state = self.__dict__.copy()
+        state.update(criteria={}, mainTypeCache={}, gfxCache={})
+        return state
+
+    def getCriteria(self, node: ET.Element) -> Criteria:
+        criteria = self.criteria.get(node)
+        if criteria is None:
+            criteria = self.criteria[node] = self.Criteria(node)
+
+        return criteria
+
+    @staticmethod
+    def roomSignature(room, path):
+        """Everything about a room that room type filters look at"""
+        info = room.info
+        return (info.type, info.variant, info.subtype, room.name, path)
+
     def count(self):
         if self.xml is not None:
             return len(self.xml)
@@ -279,6 +405,8 @@ class RoomTypeLookup(Lookup):
             self.xml = root
             initialLoad = True
 
+        self.clearCache()
+
         def mapRoomType(roomType):
             name = roomType.get("Name")
             if name is None:
@@ -312,27 +440,24 @@ class RoomTypeLookup(Lookup):
             self.xml.extend(roomTypes)
 
     def filterRoom(self, node, room, path=None):
-        typeF = node.get("Type")
-        if typeF and typeF != str(room.info.type):
+        criteria = self.getCriteria(node)
+
+        if criteria.type and criteria.type != str(room.info.type):
             return False
 
-        nameRegex = node.get("NameRegex")
-        if nameRegex and not re.match(nameRegex, room.name):
+        if criteria.nameRegex and not criteria.nameRegex.match(room.name):
             return False
 
-        stageName = node.get("StageName")
         # TODO replace with check against room file stage
-        if stageName and path:
+        if criteria.stageName and path:
             stage = self.parent.stages.lookupOne(path=path)
-            if not stage or stage.get("Name") != stageName:
+            if not stage or stage.get("Name") != criteria.stageName:
                 return False
 
-        idCriteria = parseCriteria(node.get("ID"))
-        if idCriteria and not idCriteria(room.info.variant):
+        if criteria.id and not criteria.id(room.info.variant):
             return False
 
-        subtypeCriteria = parseCriteria(node.get("Subtype"))
-        if subtypeCriteria and not subtypeCriteria(room.info.subtype):
+        if criteria.subtype and not criteria.subtype(room.info.subtype):
             return False
 
         return True
@@ -371,39 +496,42 @@ class RoomTypeLookup(Lookup):
             return None
 
     def getMainType(self, room=None, roomfile=None, path=None):
+        if room is None:
+            return self._getMainType(room, path)
+
+        signature = self.roomSignature(room, path)
+        if signature not in self.mainTypeCache:
+            self.mainTypeCache[signature] = self._getMainType(room, path)
+
+        return self.mainTypeCache[signature]
+
+    def _getMainType(self, room, path):
         candidates = self.lookup(room=room, path=path)
         if not candidates:
             return None
 
-        getCritWeight = lambda r, k, w: w if r.get(k) is not None else 0
-
-        candidates = sorted(
-            candidates,
-            key=lambda r: -(
-                getCritWeight(r, "Type", 1)
-                + getCritWeight(r, "NameRegex", 10)
-                + getCritWeight(r, "StageName", 10)
-                # + getCritWeight(r, "ID", 10)
-                + getCritWeight(r, "Subtype", 10)
-            ),
-        )
-
-        return candidates[0]
+        return max(candidates, key=lambda r: self.getCriteria(r).weight)
 
     def getGfx(
         self, node: ET.Element, room=None, roomfile=None, path=None
     ) -> ET.Element | None:
-        possibleGfx = node.findall("Gfx")
-        possibleGfx = sorted(possibleGfx, key=lambda g: -len(g.attrib))
+        possibleGfx = self.getCriteria(node).gfx
 
         if room is None:
             return possibleGfx[0]
 
+        key = (node, self.roomSignature(room, path))
+        if key in self.gfxCache:
+            return self.gfxCache[key]
+
+        match = None
         for gfx in possibleGfx:
             if self.filterRoom(gfx, room, path=path):
-                return gfx
+                match = gfx
+                break
 
-        return None
+        self.gfxCache[key] = match
+        return match
 
 
 class EntityLookup(Lookup):
@@ -605,8 +733,12 @@ class EntityLookup(Lookup):
             self.invalidBitfield = False
             self.bitfields = []
             self.tags = {}
+            self.tagMask = 0
             self.uniqueid = -1
+            self.indexKey = None
             self.tagsString = "[]"
+            # node whose checks were deferred by a lazy load, see resolve
+            self.pendingNode = None
 
         def __str__(self):
             return Entity.toString(self.type, self.variant, self.subtype, self.name)
@@ -627,19 +759,31 @@ class EntityLookup(Lookup):
 
         def addTag(self, tag):
             tag = self.getTagConfig(tag)
-            if tag and tag.tag not in self.tags:
+            if tag and not self.tagMask & tag.bit:
                 self.tags[tag.tag] = tag
+                self.tagMask |= tag.bit
                 self.tagsString = self.printTags()
 
         def removeTag(self, tag):
             tag = self.getTagConfig(tag)
-            if tag and tag.tag in self.tags:
-                self.tags[tag.tag] = None
+            if tag and self.tagMask & tag.bit:
+                del self.tags[tag.tag]
+                self.tagMask &= ~tag.bit
                 self.tagsString = self.printTags()
 
         def hasTag(self, tag):
             tag = self.getTagConfig(tag)
-            return tag and tag.tag in self.tags
+            return tag is not None and self.tagMask & tag.bit != 0
+
+        def matchesTagMask(self, tagMask, matchAnyTag=False):
+            """Checks the entity's tags against a mask from EntityLookup.getTagMask"""
+            if not tagMask:
+                return False
+
+            if matchAnyTag:
+                return self.tagMask & tagMask != 0
+
+            return self.tagMask & tagMask == tagMask
 
         def validateImagePath(self, imagePath, resourcePath, default=None):
             if imagePath is None:
@@ -701,15 +845,14 @@ class EntityLookup(Lookup):
                 return None, False, None
 
             adjustedId = 1000 if self.type == 999 else self.type
-            query = f"entity[@id='{adjustedId}'][@variant='{self.variant}']"
 
             validMissingSubtype = False
-            entityXML = self.mod.entities2root.find(
-                query + f"[@subtype='{self.subtype}']"
+            entityXML = self.mod.getEntities2Entry(
+                adjustedId, self.variant, self.subtype
             )
 
             if entityXML is None:
-                entityXML = self.mod.entities2root.find(query)
+                entityXML = self.mod.getEntities2Entry(adjustedId, self.variant)
                 validMissingSubtype = entityXML is not None
 
             if entityXML is None:
@@ -737,9 +880,11 @@ class EntityLookup(Lookup):
 
             return entityXML, False, None
 
-        def fillFromNode(self, node: ET.Element):
-            warnings = ""
-
+        def fillFromNode(self, node: ET.Element, lazy=False):
+            """
+            Fills the entity from its xml node. A lazy fill only takes the ids, name,
+            tags and flags, leaving images, bitfields and entities2 checks for resolve
+            """
             if node.get("Name"):
                 self.name = node.get("Name")
 
@@ -752,27 +897,12 @@ class EntityLookup(Lookup):
             if node.get("Subtype"):
                 self.subtype = int(node.get("Subtype"))
 
-            if node.get("Image"):
-                self.imagePath = self.validateImagePath(
-                    node.get("Image"),
-                    self.mod.resourcePath,
-                    "resources/Entities/questionmark.png",
-                )
-
-            if node.get("EditorImage"):
-                self.editorImagePath = self.validateImagePath(
-                    node.get("EditorImage"), self.mod.resourcePath
-                )
-
-            if node.get("OverlayImage"):
-                self.overlayImagePath = self.validateImagePath(
-                    node.get("OverlayImage"), self.mod.resourcePath
-                )
-
             # Tags="" attribute allows overriding default tags with nothing / different tags
             tagsString = node.get("Tags")
             if tagsString is not None:
                 self.tags = {}
+                self.tagMask = 0
+                self.tagsString = self.printTags()
                 if tagsString != "":
                     for tag in tagsString.split(","):
                         self.addTag(tag.strip())
@@ -795,6 +925,60 @@ class EntityLookup(Lookup):
             if node.get("UsePitTiling"):
                 self.renderPit = node.get("UsePitTiling") == "1"
 
+            if node.get("UseRockTiling"):
+                self.renderRock = node.get("UseRockTiling") == "1"
+
+            if node.get("Boss") == "1":
+                self.addTag("Boss")
+
+            if node.get("Champion"):
+                self.addTag("Champion")
+
+            if node.get("PlaceVisual"):
+                self.placeVisual = node.get("PlaceVisual")
+
+            if node.get("Invalid"):
+                self.invalid = True
+
+            if node.find("Gfx") is not None:
+                self.gfx = node.find("Gfx")
+
+            def getMirrorEntity(s):
+                return list(map(int, s.split(".")))
+
+            mirrorX, mirrorY = node.get("MirrorX"), node.get("MirrorY")
+            if mirrorX:
+                self.mirrorX = getMirrorEntity(mirrorX)
+            if mirrorY:
+                self.mirrorY = getMirrorEntity(mirrorY)
+
+            if lazy:
+                self.pendingNode = node
+                return ""
+
+            return self.fillChecksFromNode(node)
+
+        def fillChecksFromNode(self, node: ET.Element):
+            """The part of fillFromNode that touches the disk, bitfields and entities2"""
+            warnings = ""
+
+            if node.get("Image"):
+                self.imagePath = self.validateImagePath(
+                    node.get("Image"),
+                    self.mod.resourcePath,
+                    "resources/Entities/questionmark.png",
+                )
+
+            if node.get("EditorImage"):
+                self.editorImagePath = self.validateImagePath(
+                    node.get("EditorImage"), self.mod.resourcePath
+                )
+
+            if node.get("OverlayImage"):
+                self.overlayImagePath = self.validateImagePath(
+                    node.get("OverlayImage"), self.mod.resourcePath
+                )
+
             pitextras = node.findall("pitextra")
             if len(pitextras) != 0:
                 self.renderPitExtraConnections = []
@@ -811,9 +995,6 @@ class EntityLookup(Lookup):
                             f"Entity {node.attrib} Has pitextra with no Image attribute: {pitextraNode}"
                         )
 
-            if node.get("UseRockTiling"):
-                self.renderRock = node.get("UseRockTiling") == "1"
-
             entities2Node, invalid, mismatchedName = self.getEntities2Node()
             if invalid:
                 warnings += "\n\tHas no entry in entities2.xml!"
@@ -837,24 +1018,13 @@ class EntityLookup(Lookup):
             elif self.armor is None and entities2Node is not None:
                 self.armor = entities2Node.get("shieldStrength")
 
-            if node.get("Boss") == "1" or (
-                entities2Node is not None and entities2Node.get("boss") == "1"
-            ):
+            if entities2Node is not None and entities2Node.get("boss") == "1":
                 self.addTag("Boss")
 
-            if node.get("Champion") or (
-                entities2Node is not None and entities2Node.get("champion") == "1"
-            ):
+            if entities2Node is not None and entities2Node.get("champion") == "1":
                 self.addTag("Champion")
 
-            if node.get("PlaceVisual"):
-                self.placeVisual = node.get("PlaceVisual")
-
-            if node.get("Invalid"):
-                self.invalid = True
-
             if node.find("Gfx") is not None:
-                self.gfx = node.find("Gfx")
                 bgPrefix = self.gfx.get("BGPrefix")
                 if bgPrefix:
                     self.gfx.set(
@@ -864,15 +1034,6 @@ class EntityLookup(Lookup):
                         ),
                     )
 
-            def getMirrorEntity(s):
-                return list(map(int, s.split(".")))
-
-            mirrorX, mirrorY = node.get("MirrorX"), node.get("MirrorY")
-            if mirrorX:
-                self.mirrorX = getMirrorEntity(mirrorX)
-            if mirrorY:
-                self.mirrorY = getMirrorEntity(mirrorY)
-
             bitfields = node.findall("bitfield")
             if len(bitfields) != 0:
                 self.hasBitfields = True
@@ -903,13 +1064,41 @@ class EntityLookup(Lookup):
 
             return warnings
 
+        def resolve(self):
+            """Runs the checks a lazy fillFromNode left pending, printing their warnings"""
+            node = self.pendingNode
+            if node is None:
+                return
+
+            self.pendingNode = None
+            wasBitfieldId = self.indexKey is not None and self.indexKey[1]
+
+            warnings = self.fillChecksFromNode(node)
+            if warnings != "":
+                printf(warnings)
+
+            # invalid bitfields are dropped, which changes where the entity is indexed
+            if wasBitfieldId and not self.hasBitfieldId() and self.parent:
+                self.parent.unindexEntity(self)
+                self.parent.indexEntity(self)
+
         def hasBitfieldKey(self, key):
             for bitfield in self.bitfields:
                 if bitfield.key == key:
                     return True
 
+            # bitfields aren't parsed until resolve, go by what the node declares
+            if self.pendingNode is not None:
+                for bitfieldNode in self.pendingNode.findall("bitfield"):
+                    if bitfieldNode.get("Key", "Subtype") == key:
+                        return True
+
             return False
 
+        def hasBitfieldId(self):
+            """Whether the entity matches more than its own variant or subtype"""
+            return self.hasBitfieldKey("Variant") or self.hasBitfieldKey("Subtype")
+
         def getBitfieldElements(self):
             elements = []
             for bitfield in self.bitfields:
@@ -955,7 +1144,7 @@ class EntityLookup(Lookup):
             if not self.parent:
                 return "None"
 
-            return f'[{", ".join(map(lambda t: t.label, filter(lambda tag: self.hasTag(tag) and tag.label, self.parent.tags.values())))}]'
+            return f'[{", ".join(map(lambda t: t.label, filter(lambda tag: self.tagMask & tag.bit and tag.label, self.parent.tags.values())))}]'
 
         def matches(
             self,
@@ -965,6 +1154,7 @@ class EntityLookup(Lookup):
             name=None,
             tags=None,
             matchAnyTag=False,
+            tagMask=None,
         ):
             if name is not None and self.name != name:
                 return False
@@ -978,17 +1168,14 @@ class EntityLookup(Lookup):
                 self.subtype != subtype and not self.hasBitfieldKey("Subtype")
             ):
                 return False
-            if tags is not None:
-                matchedAny = False
-                for tag in tags:
-                    if self.hasTag(tag):
-                        matchedAny = True
-                    elif not matchAnyTag:
-                        return False
-
-                if not matchedAny:
+            if tags is not None and tagMask is None:
+                if not self.parent:
                     return False
 
+                tagMask = self.parent.getTagMask(tags, matchAnyTag)
+            if tagMask is not None and not self.matchesTagMask(tagMask, matchAnyTag):
+                return False
+
             return True
 
     DEFAULT_ENTITY_CONFIG = EntityConfig()
@@ -1042,14 +1229,20 @@ class EntityLookup(Lookup):
             self.filterable = node.get("Filterable") == "1"
             self.statisticsgroup = node.get("StatisticsGroup") == "1"
             self.attribute = node.get("Attribute")
+            self.bit = 0
 
     def __init__(self, version, parent):
         self.entityList = self.GroupConfig()
         self.entityListByType = {}
+        self.entityListByKey = {}
+        self.bitfieldEntitiesByType = {}
+        self.entityListByName = {}
         self.groups = {}
         self.tags = {}
         self.tabs = []
         self.lastuniqueid = 0
+        # set once any entity was lazily loaded, see EntityConfig.resolve
+        self.hasPendingEntities = False
         super().__init__("Entities", version)
         self.parent = parent
 
@@ -1061,10 +1254,51 @@ class EntityLookup(Lookup):
         entity.uniqueid = self.lastuniqueid
         self.entityList.addEntry(entity)
 
-        if entity.type not in self.entityListByType:
-            self.entityListByType[entity.type] = []
+        self.indexEntity(entity)
+
+    _byUniqueId = attrgetter("uniqueid")
 
-        self.entityListByType[entity.type].append(entity)
+    def indexEntity(self, entity: EntityConfig):
+        """
+        Files the entity under its current name, type, variant and subtype; entities with
+        variant or subtype bitfields can match any of those, so they're filed under just their type
+        """
+        key = (entity.type, entity.variant, entity.subtype)
+        isBitfield = entity.hasBitfieldId()
+        entity.indexKey = (key, isBitfield, entity.name)
+
+        insort(
+            self.entityListByName.setdefault(entity.name, []),
+            entity,
+            key=self._byUniqueId,
+        )
+
+        # kept in the order entities were added, so lookups return the earliest
+        insort(
+            self.entityListByType.setdefault(entity.type, []),
+            entity,
+            key=self._byUniqueId,
+        )
+
+        if isBitfield:
+            entities = self.bitfieldEntitiesByType.setdefault(entity.type, [])
+        else:
+            entities = self.entityListByKey.setdefault(key, [])
+        insort(entities, entity, key=self._byUniqueId)
+
+    def unindexEntity(self, entity: EntityConfig):
+        if entity.indexKey is None:
+            return
+
+        key, isBitfield, name = entity.indexKey
+        entity.indexKey = None
+
+        self.entityListByName[name].remove(entity)
+        self.entityListByType[key[0]].remove(entity)
+        if isBitfield:
+            self.bitfieldEntitiesByType[key[0]].remove(entity)
+        else:
+            self.entityListByKey[key].remove(entity)
 
     def loadEntityNode(
         self, node: ET.Element, mod, parentGroup: GroupConfig | None = None
@@ -1133,15 +1367,22 @@ class EntityLookup(Lookup):
                 entityConfig = self.EntityConfig(mod, self)
 
         if entityConfig:
+            # overwriting can change the name, id or bitfields the entity is indexed by
+            if overwrite:
+                self.unindexEntity(entityConfig)
+
             entityConfig.mod = mod
             if parentGroup is not None and parentGroup.entityDefaults:
                 entityConfig.fillFromConfig(parentGroup.entityDefaults)
 
-            warnings = entityConfig.fillFromNode(node)
+            warnings = entityConfig.fillFromNode(node, lazy=mod.lazy)
+            self.hasPendingEntities |= mod.lazy
             if warnings != "":
                 printf(warnings)
 
-            if not overwrite:
+            if overwrite:
+                self.indexEntity(entityConfig)
+            else:
                 self.addEntity(entityConfig)
 
         groups = []
@@ -1221,10 +1462,49 @@ class EntityLookup(Lookup):
                 return None
 
             tag = self.TagConfig(node)
+            tag.bit = 1 << len(self.tags)
             self.tags[tag.tag] = tag
 
         return self.tags[name]
 
+    def getTagMask(self, tags, matchAnyTag=False):
+        """
+        Combines tags, given as names or TagConfigs, into a mask for
+        EntityConfig.matchesTagMask. Undefined tags can't be matched, so when every
+        tag is required one of them being undefined gives an empty mask
+        """
+        tagMask = 0
+        for tag in tags:
+            if not isinstance(tag, EntityLookup.TagConfig):
+                tag = self.getTag(name=tag)
+                if tag is None:
+                    if matchAnyTag:
+                        continue
+                    return 0
+
+            tagMask |= tag.bit
+
+        return tagMask
+
+    def resolveEntities(self, entities):
+        """Resolves any lazily loaded entities among the given ones"""
+        if not self.hasPendingEntities:
+            return
+
+        for entity in [entity for entity in entities if entity.pendingNode is not None]:
+            entity.resolve()
+
+    def lookupByTagMask(self, tagMask, matchAnyTag=False, entities=None):
+        """Returns the entities matching a mask from getTagMask"""
+        if entities is None:
+            entities = self.entityList.entries
+
+        self.resolveEntities(entities)
+
+        return [
+            entity for entity in entities if entity.matchesTagMask(tagMask, matchAnyTag)
+        ]
+
     def loadDefaultsNode(self, node: ET.Element, mod, group):
         for subNode in node:
             if subNode.tag == "entity":
@@ -1268,7 +1548,7 @@ class EntityLookup(Lookup):
                 self.getTag(subNode)
 
     def loadFile(self, path, mod):
-        root = loadXMLFile(path)
+        root = self.parent.loadXMLFile(path)
         if root is None:
             return
 
@@ -1279,7 +1559,11 @@ class EntityLookup(Lookup):
         if mod.autogenerateContent and mod.entities2root is not None:
             self.loadXML(
                 generateXMLFromEntities2(
-                    mod.modPath, mod.name, mod.entities2root, mod.resourcePath
+                    mod.modPath,
+                    mod.name,
+                    mod.entities2root,
+                    mod.resourcePath,
+                    self.parent.addSource,
                 ),
                 mod,
             )
@@ -1301,7 +1585,14 @@ class EntityLookup(Lookup):
         entities=None,
     ) -> list[EntityConfig]:
         if entities is None:
-            if entitytype is not None:
+            if name is not None:
+                entities = self.entityListByName.get(name, [])
+            elif entitytype is not None and variant is not None and subtype is not None:
+                entities = self.entityListByKey.get((entitytype, variant, subtype), [])
+                bitfieldEntities = self.bitfieldEntitiesByType.get(entitytype)
+                if bitfieldEntities:
+                    entities = sorted(entities + bitfieldEntities, key=self._byUniqueId)
+            elif entitytype is not None:
                 if entitytype in self.entityListByType:
                     entities = self.entityListByType[entitytype]
                 else:
@@ -1309,10 +1600,24 @@ class EntityLookup(Lookup):
             else:
                 entities = self.entityList.entries
 
+        # entities2 can add tags and bitfields can turn out invalid, so finish
+        # loading lazy entities before matching them
+        self.resolveEntities(entities)
+
+        # resolve the tags once rather than for every entity
+        tagMask = None
+        if tags is not None:
+            tagMask = self.getTagMask(tags, matchAnyTag)
+
         entities = list(
             filter(
                 lambda entity: entity.matches(
-                    entitytype, variant, subtype, name, tags, matchAnyTag
+                    entitytype,
+                    variant,
+                    subtype,
+                    name,
+                    matchAnyTag=matchAnyTag,
+                    tagMask=tagMask,
                 ),
                 entities,
             )
@@ -1414,23 +1719,59 @@ class MainLookup:
             resourcePath="resources/",
             modPath=None,
             autogenerateContent=False,
+            parsedFiles=None,
+            lazy=False,
         ):
             self.name = modName
             self.resourcePath = resourcePath
             self.modPath = modPath
             self.autogenerateContent = autogenerateContent
+            # whether entities defer their checks until they're used
+            self.lazy = lazy
 
             self.entities2root = None
+            self.entities2Index = {}
             if self.modPath:
                 entities2Path = os.path.join(modPath, "content/entities2.xml")
                 if os.path.exists(entities2Path):
                     try:
-                        self.entities2root = ET.parse(entities2Path).getroot()
+                        self.entities2root = parseXMLFile(entities2Path, parsedFiles)
                     except ET.ParseError as e:
                         printf(f'ERROR parsing entities2 xml for mod "{modName}": {e}')
                         return
 
+                    self.indexEntities2()
+
+        def indexEntities2(self):
+            """
+            Indexes entities2 entries by (id, variant, subtype) and (id, variant), keeping
+            the first entry in the file for each like an xpath find would
+            """
+            for node in self.entities2root.findall("entity"):
+                entityId, variant = node.get("id"), node.get("variant")
+                if entityId is None or variant is None:
+                    continue
+
+                self.entities2Index.setdefault((entityId, variant), node)
+
+                subtype = node.get("subtype")
+                if subtype is not None:
+                    self.entities2Index.setdefault((entityId, variant, subtype), node)
+
+        def getEntities2Entry(self, entityId, variant, subtype=None):
+            """Finds an entities2 entry, matching any subtype if none is given"""
+            if subtype is None:
+                return self.entities2Index.get((str(entityId), str(variant)))
+
+            return self.entities2Index.get((str(entityId), str(variant), str(subtype)))
+
     def __init__(self, version, verbose):
+        # every file and folder the lookups were loaded from, for snapshots
+        self.sources = {}
+        self.addSource(__file__)
+        # roots already parsed for the mod being loaded, see parseModFiles
+        self.parsedFiles = {}
+
         self.basemod = self.ModConfig()
         self.stages = StageLookup(version, self)
         self.roomTypes = RoomTypeLookup(version, self)
@@ -1438,17 +1779,132 @@ class MainLookup:
         self.version = version
         self.verbose = verbose
 
-        self.loadXML(loadXMLFile("resources/Versions.xml"), self.basemod)
+        # image paths are resolved in bulk while loading, list their folders up front
+        prewarmDirectoryListings(self.basemod.resourcePath)
+
+        self.loadXML(self.loadXMLFile("resources/Versions.xml"), self.basemod)
+
+    def addSource(self, path):
+        """Records a file or folder the lookups depend on, whether or not it exists"""
+        self.sources[os.path.normpath(path)] = _sourceState(path)
+
+    def loadXMLFile(self, path):
+        self.addSource(path)
+        return loadXMLFile(path, self.parsedFiles)
+
+    def saveSnapshot(self, path, options=None):
+        """
+        Saves the fully loaded lookups, keyed by the options they were loaded with
+        and the state of every file and folder they were loaded from
+        """
+        for directory in usedDirectories():
+            self.addSource(directory)
+
+        tempPath = path + ".tmp"
+        try:
+            with open(tempPath, "wb") as f:
+                pickle.dump((LOOKUP_SNAPSHOT_VERSION, options, self.sources), f)
+                pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tempPath, path)
+        except Exception as e:
+            printf("Could not save lookup snapshot:", e)
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+            return
 
-    def loadFromMod(self, modPath, brPath, name, autogenerateContent):
-        modConfig = self.ModConfig(name, brPath, modPath, autogenerateContent)
-        versionsPath = os.path.join(brPath, "VersionsMod.xml")
-        if os.path.exists(versionsPath):
-            self.loadXML(loadXMLFile(versionsPath), modConfig)
+        # writing the snapshot must not touch anything it depends on, like a folder
+        # it was saved into, or the next launch could never reuse it
+        changed = _changedSource(self.sources)
+        if changed is not None:
+            printf(
+                "Discarding lookup snapshot, saving it changed one of its sources:",
+                changed,
+            )
+            os.remove(path)
+
+    @staticmethod
+    def loadSnapshot(path, options=None):
+        """
+        Loads lookups saved by saveSnapshot, or returns None if there isn't one
+        or anything they were loaded from has changed since
+        """
+        try:
+            with open(path, "rb") as f:
+                version, snapshotOptions, sources = pickle.load(f)
+                if version != LOOKUP_SNAPSHOT_VERSION or snapshotOptions != options:
+                    return None
+
+                changed = _changedSource(sources)
+                if changed is not None:
+                    printf("Lookup snapshot is out of date,", changed, "changed")
+                    return None
+
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            printf("Could not load lookup snapshot:", e)
+            return None
+
+    @staticmethod
+    def parseModFiles(modPath, brPath):
+        """
+        Parses the xml files loadFromMod would read for a mod, without touching any
+        lookups so it's safe to do for several mods at once on worker threads.
+        Returns {path: (root, parse error)} to pass on to loadFromMod
+        """
+        parsedFiles = {}
+
+        def parse(path):
+            if not os.path.isfile(path):
+                return None
+
+            root, error = None, None
+            try:
+                root = ET.parse(path).getroot()
+            except Exception as e:
+                error = e
+
+            parsedFiles[os.path.normpath(path)] = (root, error)
+            return root
+
+        parse(os.path.join(modPath, "content/entities2.xml"))
+
+        versionsRoot = parse(os.path.join(brPath, "VersionsMod.xml"))
+        if versionsRoot is not None:
+            # every file any version could load, the version itself is resolved later
+            paths = {node.get("File") for node in versionsRoot.iter("*")}
+            paths.discard(None)
         else:
-            self.stages.loadFromMod(modConfig)
-            self.roomTypes.loadFromMod(modConfig)
-            self.entities.loadFromMod(modConfig)
+            paths = [
+                f"{prefix}Mod.xml" for prefix in ("Stages", "RoomTypes", "Entities")
+            ]
+
+        for path in paths:
+            parse(os.path.join(brPath, path))
+
+        return parsedFiles
+
+    def loadFromMod(
+        self, modPath, brPath, name, autogenerateContent, parsedFiles=None, lazy=False
+    ):
+        self.parsedFiles = parsedFiles or {}
+        try:
+            modConfig = self.ModConfig(
+                name, brPath, modPath, autogenerateContent, self.parsedFiles, lazy
+            )
+            self.addSource(brPath)
+            self.addSource(os.path.join(modPath, "content/entities2.xml"))
+            prewarmDirectoryListings(brPath)
+            versionsPath = os.path.join(brPath, "VersionsMod.xml")
+            if os.path.exists(versionsPath):
+                self.loadXML(self.loadXMLFile(versionsPath), modConfig)
+            else:
+                self.stages.loadFromMod(modConfig)
+                self.roomTypes.loadFromMod(modConfig)
+                self.entities.loadFromMod(modConfig)
+        finally:
+            self.parsedFiles = {}
 
     def loadXML(self, root=None, mod=None):
         if root is None:
@@ -1,12 +1,14 @@
 """Functions for converting to and from the various stb formats"""
 
-import traceback, sys
+import traceback, sys, os, json, hashlib
 import struct
+import mmap, gc
 from pathlib import Path
 import xml.etree.cElementTree as ET
 from xml.dom import minidom
 from xml.sax.saxutils import escape
 import re, datetime
+from contextlib import contextmanager
 
 import cProfile
 
@@ -18,11 +20,43 @@ else:
     from src.util import printf
 
 
+@contextmanager
+def _safeWrite(destPath, mode):
+    """
+    Opens a file next to the destination for writing, which replaces the destination
+    once writing finishes, so a failed conversion doesn't leave a truncated room file behind
+    """
+    tempPath = f"{destPath}.tmp"
+    try:
+        with open(tempPath, mode) as out:
+            yield out
+
+        os.replace(tempPath, destPath)
+    except:
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+        raise
+
+
 def _xmlStrFix(x):
     quot = "&quot;"
     return escape(x).replace('"', quot)
 
 
+_stbHeaderPacker = struct.Struct("<4sI")
+_stbRBHeaderPacker = struct.Struct("<I")
+_stbABRoomBegPacker = struct.Struct("<IIIBH")
+_stbABRoomEndPacker = struct.Struct("<fBBBBH")
+_stbAntiRoomEndPacker = struct.Struct(
+    "<fBBBBH9s"
+)  # 9 padding bytes for some other room data
+_stbRBRoomBegPacker = struct.Struct("<IIBH")
+_stbRBRoomEndPacker = struct.Struct("<fBBBH")
+_stbDoorPacker = struct.Struct("<hh?")
+_stbStackPacker = struct.Struct("<hhB")
+_stbEntPacker = struct.Struct("<HHHf")
+
+
 def commonToXMLSlow(destPath, rooms, file=None, isPreview=False):
     """Converts the common format to xml nodes"""
     if isPreview and len(rooms) != 1:
@@ -113,625 +147,845 @@ def commonToXMLSlow(destPath, rooms, file=None, isPreview=False):
         out.write(xml)
 
 
-def commonToXML(destPath, rooms, file=None, isPreview=False):
-    """Converts the common format to xml nodes"""
-    if isPreview and len(rooms) != 1:
-        raise ValueError("Previews must be one room!")
-
-    def flattenDictList(l):
-        return " ".join(map(lambda p: f'{p[0]}="{p[1]}"', l))
-
-    # if BR version is out of sync, xml acts as a failsafe to ensure
-    # any extra props are written properly
-    def flattenXml(d):
-        return "".join(
-            map(lambda item: f' {item[0]}="{_xmlStrFix(str(item[1]))}"', d.items())
+def _flattenDictList(l):
+    return " ".join(map(lambda p: f'{p[0]}="{p[1]}"', l))
+
+
+# if BR version is out of sync, xml acts as a failsafe to ensure
+# any extra props are written properly
+def _flattenXml(d):
+    return "".join(
+        map(lambda item: f' {item[0]}="{_xmlStrFix(str(item[1]))}"', d.items())
+    )
+
+
+def _roomToXML(room, isPreview=False):
+    """Converts a single room in the common format to its xml text"""
+    width, height = room.info.dims
+
+    attrs = [
+        ("variant", room.info.variant),
+        ("name", _xmlStrFix(room.name)),
+        ("type", room.info.type),
+        ("subtype", room.info.subtype),
+        ("shape", room.info.shape),
+        ("width", width - 2),
+        ("height", height - 2),
+        ("difficulty", room.difficulty),
+        ("weight", room.weight),
+    ]
+
+    # extra props here
+    if room.lastTestTime:
+        attrs.append(
+            (
+                "lastTestTime",
+                room.lastTestTime.astimezone(datetime.timezone.utc).isoformat(
+                    timespec="minutes"
+                ),
+            )
         )
 
-    output = ['<?xml version="1.0" ?>\n']
-    if not isPreview:
-        output.append(f'<rooms{file and flattenXml(file.xmlProps) or ""}>\n')
-
-    for room in rooms:
-        width, height = room.info.dims
-
-        attrs = [
-            ("variant", room.info.variant),
-            ("name", _xmlStrFix(room.name)),
-            ("type", room.info.type),
-            ("subtype", room.info.subtype),
-            ("shape", room.info.shape),
-            ("width", width - 2),
-            ("height", height - 2),
-            ("difficulty", room.difficulty),
-            ("weight", room.weight),
-        ]
-
-        # extra props here
-        if room.lastTestTime:
-            attrs.append(
-                (
-                    "lastTestTime",
-                    room.lastTestTime.astimezone(datetime.timezone.utc).isoformat(
-                        timespec="minutes"
-                    ),
-                )
+    output = [f"\t<room {_flattenDictList(attrs)}{_flattenXml(room.xmlProps)}>\n"]
+
+    for door in sorted(room.info.doors, key=Room.DoorSortKey):
+        x, y, exists = door
+
+        # HACK there's a vanilla bug with xml reading that messes up L rooms
+        # remove this when rep is out or only apply it for ab+
+        if isPreview:
+            if room.info.shape == 9:
+                if x == 7 and y == 7:
+                    y = 0
+                elif x == 13 and y == 4:
+                    x = 0
+            elif room.info.shape == 10:
+                if x == 20 and y == 7:
+                    y = 0
+            elif room.info.shape == 11:
+                if x == 13 and y == 11:
+                    x = 0
+
+        output.append(f'\t\t<door exists="{exists}" x="{x - 1}" y="{y - 1}"/>\n')
+
+    for stack, x, y in room.spawns():
+        output.append(f'\t\t<spawn x="{x - 1}" y="{y - 1}">\n')
+
+        for ent in stack:
+            output.append(
+                f'\t\t\t<entity type="{ent.Type}" variant="{ent.Variant}" subtype="{ent.Subtype}" weight="{ent.weight}"{_flattenXml(ent.xmlProps)}/>\n'
             )
 
-        output.append(f"\t<room {flattenDictList(attrs)}{flattenXml(room.xmlProps)}>\n")
-
-        for door in sorted(room.info.doors, key=Room.DoorSortKey):
-            x, y, exists = door
-
-            # HACK there's a vanilla bug with xml reading that messes up L rooms
-            # remove this when rep is out or only apply it for ab+
-            if isPreview:
-                if room.info.shape == 9:
-                    if x == 7 and y == 7:
-                        y = 0
-                    elif x == 13 and y == 4:
-                        x = 0
-                elif room.info.shape == 10:
-                    if x == 20 and y == 7:
-                        y = 0
-                elif room.info.shape == 11:
-                    if x == 13 and y == 11:
-                        x = 0
+        output.append("\t\t</spawn>\n")
 
-            output.append(f'\t\t<door exists="{exists}" x="{x - 1}" y="{y - 1}"/>\n')
+    output.append("\t</room>\n")
 
-        for stack, x, y in room.spawns():
-            output.append(f'\t\t<spawn x="{x - 1}" y="{y - 1}">\n')
+    return "".join(output)
 
-            for ent in stack:
-                output.append(
-                    f'\t\t\t<entity type="{ent.Type}" variant="{ent.Variant}" subtype="{ent.Subtype}" weight="{ent.weight}"{flattenXml(ent.xmlProps)}/>\n'
-                )
 
-            output.append("\t\t</spawn>\n")
+@contextmanager
+def xmlRoomWriter(destPath, file=None):
+    """
+    Opens an xml room file for writing and yields a function that appends one room
+    in the common format to it, for writing rooms as they are produced
+    """
+    with _safeWrite(destPath, "w") as out:
+        out.write('<?xml version="1.0" ?>\n')
+        out.write(f'<rooms{file and _flattenXml(file.xmlProps) or ""}>\n')
 
-        output.append("\t</room>\n")
+        yield lambda room: out.write(_roomToXML(room))
 
-    if not isPreview:
-        output.append("</rooms>\n")
+        out.write("</rooms>\n")
 
-    with open(destPath, "w") as out:
-        out.write("".join(output))
 
+def commonToXML(destPath, rooms, file=None, isPreview=False):
+    """
+    Converts the common format to xml, writing each room out as it is converted.
+    rooms can be any iterable, including a lazy room iterator such as stbToRoomIter,
+    in which case only one room is held in memory at a time
+    """
+    if isPreview:
+        rooms = list(rooms)
+        if len(rooms) != 1:
+            raise ValueError("Previews must be one room!")
+
+        with _safeWrite(destPath, "w") as out:
+            out.write('<?xml version="1.0" ?>\n')
+            out.write(_roomToXML(rooms[0], isPreview))
+        return
+
+    with xmlRoomWriter(destPath, file) as writeRoom:
+        for room in rooms:
+            writeRoom(room)
+
+
+_stbRoomBegPackers = {
+    "STB0": _stbRBRoomBegPacker,
+    "STB1": _stbABRoomBegPacker,
+    "STB2": _stbABRoomBegPacker,
+}
+_stbRoomEndPackers = {
+    "STB0": _stbRBRoomEndPacker,
+    "STB1": _stbABRoomEndPacker,
+    "STB2": _stbAntiRoomEndPacker,
+}
+
+
+def _roomToSTB(room, stbFormat):
+    """Converts a single room in the common format to its bytes in the given stb format"""
+    doorPacker = _stbDoorPacker
+    stackPacker = _stbStackPacker
+    entPacker = _stbEntPacker
+
+    # Doors and Entities, packed first so the spawns only have to be walked once
+    body = bytearray()
+    for door in room.info.doors:
+        body += doorPacker.pack(door[0] - 1, door[1] - 1, door[2])
+
+    numSpawns = 0
+    for stack, x, y in room.spawns():
+        numSpawns += 1
+        body += stackPacker.pack(x - 1, y - 1, len(stack))
+
+        for entity in stack:
+            body += entPacker.pack(
+                entity.Type, entity.Variant, entity.Subtype, entity.weight
+            )
 
-def commonToSTBAB(path, rooms):
-    """Converts the common format to Afterbirth stb"""
-
-    headerPacker = struct.Struct("<4sI")
-    roomBegPacker = struct.Struct("<IIIBH")
-    roomEndPacker = struct.Struct("<fBBBBH")
-    doorPacker = struct.Struct("<hh?")
-    stackPacker = struct.Struct("<hhB")
-    entPacker = struct.Struct("<HHHf")
-
-    totalBytes = headerPacker.size
-    totalBytes += len(rooms) * (roomBegPacker.size + roomEndPacker.size)
-    for room in rooms:
-        totalBytes += len(room.name)
-        totalBytes += doorPacker.size * len(room.info.doors)
-        totalBytes += room.getSpawnCount() * stackPacker.size
-        for stack, x, y in room.spawns():
-            totalBytes += len(stack) * entPacker.size
-
-    out = bytearray(totalBytes)
-    off = 0
-    headerPacker.pack_into(out, off, "STB1".encode(), len(rooms))
-    off += headerPacker.size
+    width, height = room.info.dims
+    name = room.name.encode()
+    numDoors = len(room.info.doors)
 
-    for room in rooms:
-        width, height = room.info.dims
-        nameLen = len(room.name)
-
-        roomBegPacker.pack_into(
-            out,
-            off,
+    roomBegPacker = _stbRoomBegPackers[stbFormat]
+    roomEndPacker = _stbRoomEndPackers[stbFormat]
+    if stbFormat == "STB0":
+        # No subtype or shape for rebirth
+        roomBeg = roomBegPacker.pack(
+            room.info.type, room.info.variant, room.difficulty, len(name)
+        )
+        roomEnd = roomEndPacker.pack(
+            room.weight, width - 2, height - 2, numDoors, numSpawns
+        )
+    else:
+        roomBeg = roomBegPacker.pack(
             room.info.type,
             room.info.variant,
             room.info.subtype,
             room.difficulty,
-            nameLen,
+            len(name),
         )
-        off += roomBegPacker.size
-
-        struct.pack_into(f"<{nameLen}s", out, off, room.name.encode())
-        off += nameLen
-
-        # Other room info, Doors and Entities
-        roomEndPacker.pack_into(
-            out,
-            off,
+        roomEndData = (
             room.weight,
             width - 2,
             height - 2,
             room.info.shape,
-            len(room.info.doors),
-            room.getSpawnCount(),
+            numDoors,
+            numSpawns,
         )
-        off += roomEndPacker.size
+        if stbFormat == "STB2":
+            roomEndData += (bytes(9),)  # unknown extra room data
+        roomEnd = roomEndPacker.pack(*roomEndData)
 
-        for door in room.info.doors:
-            doorPacker.pack_into(out, off, door[0] - 1, door[1] - 1, door[2])
-            off += doorPacker.size
+    return b"".join((roomBeg, name, roomEnd, body))
 
-        for stack, x, y in room.spawns():
-            numEnts = len(stack)
-            stackPacker.pack_into(out, off, x - 1, y - 1, numEnts)
-            off += stackPacker.size
 
-            for entity in stack:
-                entPacker.pack_into(
-                    out, off, entity.Type, entity.Variant, entity.Subtype, entity.weight
-                )
-                off += entPacker.size
+@contextmanager
+def stbRoomWriter(path, stbFormat="STB1"):
+    """
+    Opens an stb file in the given format for writing and yields a function that
+    appends one room in the common format to it; the room count in the header is
+    filled in once the file is closed
+    """
+    headerPacker = _stbRBHeaderPacker if stbFormat == "STB0" else _stbHeaderPacker
 
-    with open(path, "wb") as stb:
-        stb.write(out)
+    with _safeWrite(path, "wb") as stb:
+        stb.write(bytes(headerPacker.size))
 
+        numRooms = 0
 
-def commonToSTBRB(path, rooms):
-    """Converts the common format to Rebirth stb"""
+        def writeRoom(room):
+            nonlocal numRooms
+            stb.write(_roomToSTB(room, stbFormat))
+            numRooms += 1
 
-    headerPacker = struct.Struct("<I")
-    roomBegPacker = struct.Struct("<IIBH")
-    roomEndPacker = struct.Struct("<fBB")
-    doorHeaderPacker = struct.Struct("<BH")
-    doorPacker = struct.Struct("<hh?")
-    stackPacker = struct.Struct("<hhB")
-    entPacker = struct.Struct("<HHHf")
+        yield writeRoom
 
-    totalBytes = headerPacker.size
-    totalBytes += len(rooms) * (roomBegPacker.size + roomEndPacker.size)
-    for room in rooms:
-        totalBytes += len(room.name)
-        totalBytes += doorHeaderPacker.size + doorPacker.size * len(room.info.doors)
-        totalBytes += room.getSpawnCount() * stackPacker.size
-        for stack, x, y in room.spawns():
-            totalBytes += len(stack) * entPacker.size
+        stb.seek(0)
+        if stbFormat == "STB0":
+            # No header for rebirth
+            stb.write(headerPacker.pack(numRooms))
+        else:
+            stb.write(headerPacker.pack(stbFormat.encode(), numRooms))
 
-    out = bytearray(totalBytes)
-    off = 0
-    headerPacker.pack_into(out, off, len(rooms))
-    off += headerPacker.size
 
-    for room in rooms:
-        width, height = room.info.dims
-        nameLen = len(room.name)
-        roomBegPacker.pack_into(
-            out, off, room.info.type, room.info.variant, room.difficulty, nameLen
-        )
-        off += roomBegPacker.size
-        struct.pack_into(f"<{nameLen}s", out, off, room.name.encode())
-        off += nameLen
-        roomEndPacker.pack_into(out, off, room.weight, width - 2, height - 2)
-        off += roomEndPacker.size
+def _commonToSTB(path, rooms, stbFormat):
+    """Writes rooms out one at a time in the given stb format, so rooms can be any iterable"""
+    with stbRoomWriter(path, stbFormat) as writeRoom:
+        for room in rooms:
+            writeRoom(room)
+
 
-        # Doors and Entities
-        doorHeaderPacker.pack_into(out, off, len(room.info.doors), room.getSpawnCount())
-        off += doorHeaderPacker.size
+def commonToSTBAB(path, rooms):
+    """Converts the common format to Afterbirth stb"""
+    _commonToSTB(path, rooms, "STB1")
 
-        for door in room.info.doors:
-            doorPacker.pack_into(out, off, door[0] - 1, door[1] - 1, door[2])
-            off += doorPacker.size
 
-        for stack, x, y in room.spawns():
-            numEnts = len(stack)
-            stackPacker.pack_into(out, off, x - 1, y - 1, numEnts)
-            off += stackPacker.size
+def commonToSTBAnti(path, rooms):
+    """Converts the common format to Antibirth stb"""
+    _commonToSTB(path, rooms, "STB2")
 
-            for entity in stack:
-                entPacker.pack_into(
-                    out, off, entity.Type, entity.Variant, entity.Subtype, entity.weight
-                )
-                off += entPacker.size
 
-    with open(path, "wb") as stb:
-        stb.write(out)
+def commonToSTBRB(path, rooms):
+    """Converts the common format to Rebirth stb"""
+    _commonToSTB(path, rooms, "STB0")
 
 
-def stbToCommon(path):
-    header = open(path, "rb").read(4)
+def _mapFile(path):
+    """Memory maps a file read-only, so rooms can be decoded without reading it all in"""
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _stbHeader(path):
+    with open(path, "rb") as f:
+        header = f.read(4)
 
     try:
         header = header.decode()
     except UnicodeDecodeError:
         header = "STB0"  # sometimes the header will actually decode successfully, so can't count on this value
 
+    return header
+
+
+def _readRoomHeaderAB(stb, off):
+    roomBegPacker = _stbABRoomBegPacker
+    roomEndPacker = _stbABRoomEndPacker
+
+    # Room Type, Room Variant, Subtype, Difficulty, Length of Room Name String
+    rtype, rvariant, rsubtype, difficulty, nameLen = roomBegPacker.unpack_from(stb, off)
+    off += roomBegPacker.size
+
+    # Room Name
+    roomName = struct.unpack_from(f"<{nameLen}s", stb, off)[0].decode()
+    off += nameLen
+
+    # Weight, width, height, shape, number of doors, number of entities
+    rweight, width, height, shape, numDoors, numEnts = roomEndPacker.unpack_from(
+        stb, off
+    )
+    off += roomEndPacker.size
+
+    width += 2
+    height += 2
+    if shape == 0:
+        printf(f"Bad room shape! {rvariant}, {roomName}, {width}, {height}")
+        shape = 1
+
+    roomHeader = (
+        roomName,
+        difficulty,
+        rweight,
+        rtype,
+        rvariant,
+        rsubtype,
+        shape,
+        numDoors,
+        numEnts,
+        None,
+    )
+    return roomHeader, off
+
+
+def _readRoomHeaderAnti(stb, off):
+    roomBegPacker = _stbABRoomBegPacker
+    roomEndPacker = _stbAntiRoomEndPacker
+
+    # Room Type, Room Variant, Subtype, Difficulty, Length of Room Name String
+    rtype, rvariant, rsubtype, difficulty, nameLen = roomBegPacker.unpack_from(stb, off)
+    off += roomBegPacker.size
+
+    # Room Name
+    roomName = struct.unpack_from(f"<{nameLen}s", stb, off)[0].decode()
+    off += nameLen
+
+    # Weight, width, height, shape, number of doors, number of entities
+    entityTable = roomEndPacker.unpack_from(stb, off)
+    rweight, width, height, shape, numDoors, numEnts, extraData = entityTable
+    off += roomEndPacker.size
+
+    width += 2
+    height += 2
+    if shape == 0:
+        printf(f"Bad room shape! {rvariant}, {roomName}, {width}, {height}")
+        shape = 1
+
+    roomHeader = (
+        roomName,
+        difficulty,
+        rweight,
+        rtype,
+        rvariant,
+        rsubtype,
+        shape,
+        numDoors,
+        numEnts,
+        extraData,
+    )
+    return roomHeader, off
+
+
+def _readRoomHeaderRB(stb, off):
+    roomBegPacker = _stbRBRoomBegPacker
+    roomEndPacker = _stbRBRoomEndPacker
+
+    # Room Type, Room Variant, Difficulty, Length of Room Name String
+    # No subtype for rebirth
+    rtype, rvariant, difficulty, nameLen = roomBegPacker.unpack_from(stb, off)
+    off += roomBegPacker.size
+
+    # Room Name
+    roomName = struct.unpack_from(f"<{nameLen}s", stb, off)[0].decode()
+    off += nameLen
+
+    # Weight, width, height, number of doors, number of entities
+    # No shape for rebirth
+    rweight, width, height, numDoors, numEnts = roomEndPacker.unpack_from(stb, off)
+    off += roomEndPacker.size
+
+    # We have to figure out the shape manually for rebirth
+    width += 2
+    height += 2
+    shape = 1
+    for s in [1, 4, 6, 8]:  # only valid room shapes as of rebirth, defaults to 1x1
+        w, h = Room.Shapes[s]["Dims"]
+        if w == width and h == height:
+            shape = s
+            break
+
+    roomHeader = (
+        roomName,
+        difficulty,
+        rweight,
+        rtype,
+        rvariant,
+        0,
+        shape,
+        numDoors,
+        numEnts,
+        None,
+    )
+    return roomHeader, off
+
+
+def _readRoomBody(stb, off, roomHeader):
+    """Reads the doors and spawns following a room header into a Room"""
+    doorPacker = _stbDoorPacker
+    stackPacker = _stbStackPacker
+    entPacker = _stbEntPacker
+
+    (
+        roomName,
+        difficulty,
+        rweight,
+        rtype,
+        rvariant,
+        rsubtype,
+        shape,
+        numDoors,
+        numEnts,
+        extraData,
+    ) = roomHeader
+
+    doors = []
+    for d in range(numDoors):
+        # X, Y, exists
+        doorX, doorY, exists = doorPacker.unpack_from(stb, off)
+        off += doorPacker.size
+
+        doors.append([doorX + 1, doorY + 1, exists])
+
+    room = Room(
+        roomName, None, difficulty, rweight, rtype, rvariant, rsubtype, shape, doors
+    )
+
+    if extraData is not None and extraData != b"\x00" * len(extraData):
+        printf(f"Room {room.getPrefix()} uses the extra bytes:", extraData)
+
+    realWidth = room.info.dims[0]
+    gridLen = room.info.gridLen()
+    for e in range(numEnts):
+        # x, y, number of entities at this position
+        ex, ey, stackedEnts = stackPacker.unpack_from(stb, off)
+        ex += 1
+        ey += 1
+        off += stackPacker.size
+
+        grindex = Room.Info.gridIndex(ex, ey, realWidth)
+        if grindex >= gridLen:
+            printf(
+                f"Discarding the current entity stack due to invalid position! {room.getPrefix()}: {ex-1},{ey-1}"
+            )
+            off += entPacker.size * stackedEnts
+            continue
+
+        ents = []
+        for s in range(stackedEnts):
+            #  type, variant, subtype, weight
+            etype, evariant, esubtype, eweight = entPacker.unpack_from(stb, off)
+            off += entPacker.size
+
+            ents.append(Entity(ex, ey, etype, evariant, esubtype, eweight))
+
+        room.addStack(grindex, ents)
+
+    return room, off
+
+
+def _iterSTBRooms(stb, off, numRooms, readRoomHeader):
+    for r in range(numRooms):
+        roomHeader, off = readRoomHeader(stb, off)
+        room, off = _readRoomBody(stb, off, roomHeader)
+        yield room
+
+
+def stbABToRoomIter(path):
+    """Lazily yields the rooms of an Afterbirth STB one at a time"""
+    with _mapFile(path) as stb:
+        # Header, Room count
+        header, rooms = _stbHeaderPacker.unpack_from(stb, 0)
+        if header.decode() != "STB1":
+            raise ValueError("Afterbirth STBs must have the STB1 header")
+
+        yield from _iterSTBRooms(stb, _stbHeaderPacker.size, rooms, _readRoomHeaderAB)
+
+
+def stbAntiToRoomIter(path):
+    """Lazily yields the rooms of an Antibirth STB one at a time"""
+    with _mapFile(path) as stb:
+        # Header, Room count
+        header, rooms = _stbHeaderPacker.unpack_from(stb, 0)
+        if header.decode() != "STB2":
+            raise ValueError("Antibirth STBs must have the STB2 header")
+
+        yield from _iterSTBRooms(stb, _stbHeaderPacker.size, rooms, _readRoomHeaderAnti)
+
+
+def stbRBToRoomIter(path):
+    """Lazily yields the rooms of a Rebirth STB one at a time"""
+    with _mapFile(path) as stb:
+        # Room count
+        # No header for rebirth
+        rooms = _stbRBHeaderPacker.unpack_from(stb, 0)[0]
+
+        yield from _iterSTBRooms(stb, _stbRBHeaderPacker.size, rooms, _readRoomHeaderRB)
+
+
+def stbToRoomIter(path):
+    """
+    Lazily yields the rooms of an STB of any format one at a time.
+    The file stays memory mapped until the iterator is exhausted or closed,
+    so scans can stop early without decoding the rest of the file
+    """
+    header = _stbHeader(path)
+
     if header == "STB1":
-        return stbABToCommon(path)
+        return stbABToRoomIter(path)
     if header == "STB2":
-        return stbAntiToCommon(path)
+        return stbAntiToRoomIter(path)
     else:
-        return stbRBToCommon(path)
+        return stbRBToRoomIter(path)
 
 
-def stbABToCommon(path):
-    """Converts an Afterbirth STB to the common format"""
-    stb = open(path, "rb").read()
+_stbRoomHeaderReaders = {
+    "STB0": _readRoomHeaderRB,
+    "STB1": _readRoomHeaderAB,
+    "STB2": _readRoomHeaderAnti,
+}
 
-    headerPacker = struct.Struct("<4sI")
-    roomBegPacker = struct.Struct("<IIIBH")
-    roomEndPacker = struct.Struct("<fBBBBH")
-    doorPacker = struct.Struct("<hh?")
-    stackPacker = struct.Struct("<hhB")
-    entPacker = struct.Struct("<HHHf")
+STB_INDEX_VERSION = 2
 
-    # Header, Room count
-    header, rooms = headerPacker.unpack_from(stb, 0)
-    off = headerPacker.size
-    if header.decode() != "STB1":
-        raise ValueError("Afterbirth STBs must have the STB1 header")
 
-    ret = []
+def _skipRoomBody(stb, off, numDoors, numEnts):
+    """Walks past a room's doors and spawns without decoding any entities"""
+    off += _stbDoorPacker.size * numDoors
+    for e in range(numEnts):
+        stackedEnts = _stbStackPacker.unpack_from(stb, off)[2]
+        off += _stbStackPacker.size + _stbEntPacker.size * stackedEnts
 
-    for r in range(rooms):
-        # Room Type, Room Variant, Subtype, Difficulty, Length of Room Name String
-        roomData = roomBegPacker.unpack_from(stb, off)
-        rtype, rvariant, rsubtype, difficulty, nameLen = roomData
-        off += roomBegPacker.size
-        # print ("Room Data: {roomData}")
-
-        # Room Name
-        roomName = struct.unpack_from(f"<{nameLen}s", stb, off)[0].decode()
-        off += nameLen
-        # print (f"Room Name: {roomName}")
-
-        # Weight, width, height, shape, number of doors, number of entities
-        entityTable = roomEndPacker.unpack_from(stb, off)
-        rweight, width, height, shape, numDoors, numEnts = entityTable
-        off += roomEndPacker.size
-        # print (f"Entity Table: {entityTable}")
-
-        width += 2
-        height += 2
-        if shape == 0:
-            printf(f"Bad room shape! {rvariant}, {roomName}, {width}, {height}")
-            shape = 1
-
-        doors = []
-        for d in range(numDoors):
-            # X, Y, exists
-            doorX, doorY, exists = doorPacker.unpack_from(stb, off)
-            off += doorPacker.size
-
-            doors.append([doorX + 1, doorY + 1, exists])
-
-        room = Room(
-            roomName, None, difficulty, rweight, rtype, rvariant, rsubtype, shape, doors
-        )
-        ret.append(room)
-
-        realWidth = room.info.dims[0]
-        gridLen = room.info.gridLen()
-        for e in range(numEnts):
-            # x, y, number of entities at this position
-            ex, ey, stackedEnts = stackPacker.unpack_from(stb, off)
-            ex += 1
-            ey += 1
-            off += stackPacker.size
-
-            grindex = Room.Info.gridIndex(ex, ey, realWidth)
-            if grindex >= gridLen:
-                printf(
-                    f"Discarding the current entity stack due to invalid position! {room.getPrefix()}: {ex-1},{ey-1}"
-                )
-                off += entPacker.size * stackedEnts
-                continue
+    return off
 
-            ents = room.gridSpawns[grindex]
 
-            for s in range(stackedEnts):
-                #  type, variant, subtype, weight
-                etype, evariant, esubtype, eweight = entPacker.unpack_from(stb, off)
-                off += entPacker.size
+def stbBuildRoomIndex(path):
+    """
+    Reads only the room headers of an STB, returning its format and a
+    (type, variant, subtype, name, byte offset, byte length) entry per room
+    """
+    stbFormat = _stbHeader(path)
+    if stbFormat not in _stbRoomHeaderReaders:
+        stbFormat = "STB0"
 
-                ents.append(Entity(ex, ey, etype, evariant, esubtype, eweight))
+    readRoomHeader = _stbRoomHeaderReaders[stbFormat]
 
-            room.gridSpawns = room.gridSpawns
+    entries = []
+    with _mapFile(path) as stb:
+        if stbFormat == "STB0":
+            rooms = _stbRBHeaderPacker.unpack_from(stb, 0)[0]
+            off = _stbRBHeaderPacker.size
+        else:
+            rooms = _stbHeaderPacker.unpack_from(stb, 0)[1]
+            off = _stbHeaderPacker.size
 
-    return File(ret)
+        for r in range(rooms):
+            roomOff = off
+            roomHeader, off = readRoomHeader(stb, off)
+            roomName, _, _, rtype, rvariant, rsubtype, _, numDoors, numEnts, _ = (
+                roomHeader
+            )
+            off = _skipRoomBody(stb, off, numDoors, numEnts)
 
+            entries.append(
+                (rtype, rvariant, rsubtype, roomName, roomOff, off - roomOff)
+            )
 
-def stbAntiToCommon(path):
-    """Converts an Antibirth STB to the common format"""
-    stb = open(path, "rb").read()
-
-    headerPacker = struct.Struct("<4sI")
-    roomBegPacker = struct.Struct("<IIIBH")
-    roomEndPacker = struct.Struct(
-        "<fBBBBH9s"
-    )  # 9 padding bytes for some other room data
-    doorPacker = struct.Struct("<hh?")
-    stackPacker = struct.Struct("<hhB")
-    entPacker = struct.Struct("<HHHf")
-
-    # Header, Room count
-    header, rooms = headerPacker.unpack_from(stb, 0)
-    off = headerPacker.size
-    if header.decode() != "STB2":
-        raise ValueError("Antibirth STBs must have the STB2 header")
+    return stbFormat, entries
 
-    ret = []
 
-    for r in range(rooms):
-        # Room Type, Room Variant, Subtype, Difficulty, Length of Room Name String
-        roomData = roomBegPacker.unpack_from(stb, off)
-        rtype, rvariant, rsubtype, difficulty, nameLen = roomData
-        off += roomBegPacker.size
-        # print ("Room Data: {roomData}")
-
-        # Room Name
-        roomName = struct.unpack_from(f"<{nameLen}s", stb, off)[0].decode()
-        off += nameLen
-        # print (f"Room Name: {roomName}")
-
-        # Weight, width, height, shape, number of doors, number of entities
-        entityTable = roomEndPacker.unpack_from(stb, off)
-        rweight, width, height, shape, numDoors, numEnts, extraData = entityTable
-        off += roomEndPacker.size
-        # print (f"Entity Table: {entityTable}")
-
-        width += 2
-        height += 2
-        if shape == 0:
-            printf(f"Bad room shape! {rvariant}, {roomName}, {width}, {height}")
-            shape = 1
-
-        doors = []
-        for d in range(numDoors):
-            # X, Y, exists
-            doorX, doorY, exists = doorPacker.unpack_from(stb, off)
-            off += doorPacker.size
-
-            doors.append([doorX + 1, doorY + 1, exists])
-
-        room = Room(
-            roomName, None, difficulty, rweight, rtype, rvariant, rsubtype, shape, doors
-        )
-        ret.append(room)
-
-        if extraData != b"\x00\x00\x00\x00\x00\x00\x00\x00\x00":
-            printf(f"Room {room.getPrefix()} uses the extra bytes:", extraData)
-
-        realWidth = room.info.dims[0]
-        gridLen = room.info.gridLen()
-        for e in range(numEnts):
-            # x, y, number of entities at this position
-            ex, ey, stackedEnts = stackPacker.unpack_from(stb, off)
-            ex += 1
-            ey += 1
-            off += stackPacker.size
-
-            grindex = Room.Info.gridIndex(ex, ey, realWidth)
-            if grindex >= gridLen:
-                printf(
-                    f"Discarding the current entity stack due to invalid position! {room.getPrefix()}: {ex-1},{ey-1}"
-                )
-                off += entPacker.size * stackedEnts
-                continue
+def _stbIndexPath(path, cacheDir):
+    name = hashlib.sha256(os.path.abspath(path).encode()).hexdigest()
+    return Path(cacheDir) / (name + ".json")
 
-            ents = room.gridSpawns[grindex]
 
-            for s in range(stackedEnts):
-                #  type, variant, subtype, weight
-                etype, evariant, esubtype, eweight = entPacker.unpack_from(stb, off)
-                off += entPacker.size
+def stbRoomIndex(path, cacheDir=None):
+    """
+    Returns the room index of an STB (see stbBuildRoomIndex). With a cache folder the
+    index is also kept there and reused for as long as the STB's size and mtime match,
+    nothing is ever written next to the STB itself
+    """
+    if cacheDir is None:
+        return stbBuildRoomIndex(path)
 
-                ents.append(Entity(ex, ey, etype, evariant, esubtype, eweight))
+    stat = os.stat(path)
+    key = [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+    indexPath = _stbIndexPath(path, cacheDir)
 
-            room.gridSpawns = room.gridSpawns
+    if indexPath.is_file():
+        try:
+            with open(indexPath) as indexFile:
+                cached = json.load(indexFile)
 
-    return File(ret)
+            if cached["version"] == STB_INDEX_VERSION and cached["key"] == key:
+                return cached["format"], list(map(tuple, cached["rooms"]))
+        except (OSError, ValueError, KeyError) as e:
+            printf("Ignoring unreadable STB index", indexPath, e)
 
+    stbFormat, entries = stbBuildRoomIndex(path)
 
-def stbRBToCommon(path):
-    """Converts an Rebirth STB to the common format"""
-    stb = open(path, "rb").read()
-
-    headerPacker = struct.Struct("<I")
-    roomBegPacker = struct.Struct("<IIBH")
-    roomEndPacker = struct.Struct("<fBBBH")
-    doorPacker = struct.Struct("<hh?")
-    stackPacker = struct.Struct("<hhB")
-    entPacker = struct.Struct("<HHHf")
-
-    # Room count
-    # No header for rebirth
-    rooms = headerPacker.unpack_from(stb, 0)[0]
-    off = headerPacker.size
-    ret = []
+    try:
+        indexPath.parent.mkdir(parents=True, exist_ok=True)
+        with _safeWrite(indexPath, "w") as indexFile:
+            json.dump(
+                {
+                    "version": STB_INDEX_VERSION,
+                    "key": key,
+                    "format": stbFormat,
+                    "rooms": entries,
+                },
+                indexFile,
+            )
+    except OSError as e:
+        printf("Could not save STB index", indexPath, e)
 
-    for r in range(rooms):
-        # Room Type, Room Variant, Difficulty, Length of Room Name String
-        # No subtype for rebirth
-        roomData = roomBegPacker.unpack_from(stb, off)
-        rtype, rvariant, difficulty, nameLen = roomData
-        off += roomBegPacker.size
-        # print ("Room Data: {roomData}")
-
-        # Room Name
-        roomName = struct.unpack_from(f"<{nameLen}s", stb, off)[0].decode()
-        off += nameLen
-        # print (f"Room Name: {roomName}")
-
-        # Weight, width, height, number of doors, number of entities
-        # No shape for rebirth
-        entityTable = roomEndPacker.unpack_from(stb, off)
-        rweight, width, height, numDoors, numEnts = entityTable
-        off += roomEndPacker.size
-        # print (f"Entity Table: {entityTable}")
-
-        # We have to figure out the shape manually for rebirth
-        width += 2
-        height += 2
-        shape = 1
-        for s in [1, 4, 6, 8]:  # only valid room shapes as of rebirth, defaults to 1x1
-            w, h = Room.Info(shape=s).dims
-            if w == width and h == height:
-                shape = s
-                break
+    return stbFormat, entries
 
-        doors = []
-        for d in range(numDoors):
-            # X, Y, exists
-            doorX, doorY, exists = doorPacker.unpack_from(stb, off)
-            off += doorPacker.size
 
-            doors.append([doorX + 1, doorY + 1, exists])
+def stbReadRoom(path, stbFormat, entry):
+    """Decodes the single room described by a room index entry"""
+    off, length = entry[4], entry[5]
+    with open(path, "rb") as stb:
+        stb.seek(off)
+        data = stb.read(length)
 
-        room = Room(
-            roomName, None, difficulty, rweight, rtype, rvariant, 0, shape, doors
-        )
-        ret.append(room)
-
-        realWidth = room.info.dims[0]
-        gridLen = room.info.gridLen()
-        for e in range(numEnts):
-            # x, y, number of entities at this position
-            ex, ey, stackedEnts = stackPacker.unpack_from(stb, off)
-            ex += 1
-            ey += 1
-            off += stackPacker.size
-
-            grindex = Room.Info.gridIndex(ex, ey, realWidth)
-            if grindex >= gridLen:
-                printf(
-                    f"Discarding the current entity stack due to invalid position! {room.getPrefix()}: {ex-1},{ey-1}"
-                )
-                off += entPacker.size * stackedEnts
-                continue
+    roomHeader, off = _stbRoomHeaderReaders[stbFormat](data, 0)
+    room, off = _readRoomBody(data, off, roomHeader)
+    return room
 
-            ents = room.gridSpawns[grindex]
 
-            for s in range(stackedEnts):
-                #  type, variant, subtype, weight
-                etype, evariant, esubtype, eweight = entPacker.unpack_from(stb, off)
-                off += entPacker.size
+def stbLookupRooms(
+    path, rtype=None, variant=None, subtype=None, name=None, cacheDir=None
+):
+    """Decodes only the rooms of an STB matching the given criteria, using its room index"""
+    stbFormat, entries = stbRoomIndex(path, cacheDir)
 
-                ents.append(Entity(ex, ey, etype, evariant, esubtype, eweight))
+    return [
+        stbReadRoom(path, stbFormat, entry)
+        for entry in entries
+        if (rtype is None or entry[0] == rtype)
+        and (variant is None or entry[1] == variant)
+        and (subtype is None or entry[2] == subtype)
+        and (name is None or entry[3] == name)
+    ]
 
-            room.gridSpawns = room.gridSpawns  # used to update spawn count
 
-    return File(ret)
+def stbReplaceRooms(path, destPath, replacements, index=None):
+    """
+    Writes a copy of an STB with some of its rooms replaced, given as {position in
+    the room index: room in the common format}. Every other room's bytes are copied
+    over as they are, so only the replaced rooms are encoded
+    """
+    stbFormat, entries = index or stbRoomIndex(path)
 
+    # the mapping is closed before the copy replaces the destination
+    with _safeWrite(destPath, "wb") as out, _mapFile(path) as stb:
+        off = entries[0][4] if entries else len(stb)
+        out.write(stb[:off])
 
-def xmlToCommon(path, destPath=None):
-    """Converts an Afterbirth xml to the common format"""
+        for i, entry in enumerate(entries):
+            room = replacements.get(i)
+            if room is None:
+                out.write(stb[entry[4] : entry[4] + entry[5]])
+            else:
+                out.write(_roomToSTB(room, stbFormat))
+            off = entry[4] + entry[5]
 
-    xml = ET.parse(path)
+        out.write(stb[off:])
 
-    root = xml.getroot()  # can be stage, rooms, etc
 
-    rooms = root.findall("room")
-    ret = []
+def stbToCommon(path):
+    header = _stbHeader(path)
+
+    if header == "STB1":
+        return stbABToCommon(path)
+    if header == "STB2":
+        return stbAntiToCommon(path)
+    else:
+        return stbRBToCommon(path)
+
+
+def stbABToCommon(path):
+    """Converts an Afterbirth STB to the common format"""
+    return File(list(stbABToRoomIter(path)))
+
+
+def stbAntiToCommon(path):
+    """Converts an Antibirth STB to the common format"""
+    return File(list(stbAntiToRoomIter(path)))
 
-    for roomNode in rooms:
-        roomXmlProps = dict(roomNode.attrib)
-
-        rtype = int(roomNode.get("type") or "1")
-        del roomXmlProps["type"]
-        rvariant = int(roomNode.get("variant") or "0")
-        del roomXmlProps["variant"]
-        rsubtype = int(roomNode.get("subtype") or "0")
-        del roomXmlProps["subtype"]
-        difficulty = int(roomNode.get("difficulty") or "0")
-        del roomXmlProps["difficulty"]
-        roomName = roomNode.get("name") or ""
-        del roomXmlProps["name"]
-        rweight = float(roomNode.get("weight") or "1")
-        del roomXmlProps["weight"]
-        shape = int(roomNode.get("shape") or "-1")
-        del roomXmlProps["shape"]
-
-        if shape == -1:
-            shape = None
-            width = int(roomNode.get("width") or "13") + 2
-            height = int(roomNode.get("height") or "7") + 2
-            dims = (width, height)
-            for k, s in Room.Shapes.items():
-                if s["Dims"] == dims:
-                    shape = k
-                    break
-
-        shape = shape or 1
-
-        del roomXmlProps["width"]
-        del roomXmlProps["height"]
-
-        lastTestTime = roomXmlProps.get("lastTestTime", None)
-        if lastTestTime:
-            try:
-                lastTestTime = datetime.datetime.fromisoformat(lastTestTime)
-                del roomXmlProps["lastTestTime"]
-            except:
-                printf("Invalid test time string found", lastTestTime)
-                traceback.print_exception(*sys.exc_info())
-                lastTestTime = None
-
-        doors = list(
-            map(
-                lambda door: [
-                    int(door.get("x")) + 1,
-                    int(door.get("y")) + 1,
-                    door.get("exists", "0")[0] in "1tTyY",
-                ],
-                roomNode.findall("door"),
-            )
-        )
 
-        room = Room(
-            roomName, None, difficulty, rweight, rtype, rvariant, rsubtype, shape, doors
+def stbRBToCommon(path):
+    """Converts an Rebirth STB to the common format"""
+    return File(list(stbRBToRoomIter(path)))
+
+
+def _xmlRoomToCommon(roomNode):
+    """Converts a single room node to the common format"""
+    roomXmlProps = dict(roomNode.attrib)
+
+    rtype, rvariant = _xmlRoomHeader(roomNode)
+    del roomXmlProps["type"]
+    del roomXmlProps["variant"]
+    rsubtype = int(roomNode.get("subtype") or "0")
+    del roomXmlProps["subtype"]
+    difficulty = int(roomNode.get("difficulty") or "0")
+    del roomXmlProps["difficulty"]
+    roomName = roomNode.get("name") or ""
+    del roomXmlProps["name"]
+    rweight = float(roomNode.get("weight") or "1")
+    del roomXmlProps["weight"]
+    shape = int(roomNode.get("shape") or "-1")
+    del roomXmlProps["shape"]
+
+    if shape == -1:
+        shape = None
+        width = int(roomNode.get("width") or "13") + 2
+        height = int(roomNode.get("height") or "7") + 2
+        dims = (width, height)
+        for k, s in Room.Shapes.items():
+            if s["Dims"] == dims:
+                shape = k
+                break
+
+    shape = shape or 1
+
+    del roomXmlProps["width"]
+    del roomXmlProps["height"]
+
+    lastTestTime = roomXmlProps.get("lastTestTime", None)
+    if lastTestTime:
+        try:
+            lastTestTime = datetime.datetime.fromisoformat(lastTestTime)
+            del roomXmlProps["lastTestTime"]
+        except:
+            printf("Invalid test time string found", lastTestTime)
+            traceback.print_exception(*sys.exc_info())
+            lastTestTime = None
+
+    doors = list(
+        map(
+            lambda door: [
+                int(door.get("x")) + 1,
+                int(door.get("y")) + 1,
+                door.get("exists", "0")[0] in "1tTyY",
+            ],
+            roomNode.findall("door"),
+        )
+    )
+
+    room = Room(
+        roomName, None, difficulty, rweight, rtype, rvariant, rsubtype, shape, doors
+    )
+    room.xmlProps = roomXmlProps
+    room.lastTestTime = lastTestTime
+
+    realWidth = room.info.dims[0]
+    gridLen = room.info.gridLen()
+    for spawn in roomNode.findall("spawn"):
+        ex, ey, stackedEnts = (
+            int(spawn.get("x")) + 1,
+            int(spawn.get("y")) + 1,
+            spawn.findall("entity"),
         )
-        room.xmlProps = roomXmlProps
-        room.lastTestTime = lastTestTime
-        ret.append(room)
-
-        realWidth = room.info.dims[0]
-        gridLen = room.info.gridLen()
-        for spawn in roomNode.findall("spawn"):
-            ex, ey, stackedEnts = (
-                int(spawn.get("x")) + 1,
-                int(spawn.get("y")) + 1,
-                spawn.findall("entity"),
+
+        grindex = Room.Info.gridIndex(ex, ey, realWidth)
+        if grindex >= gridLen:
+            printf(
+                f"Discarding the current entity stack due to invalid position! {room.getPrefix()}: {ex-1},{ey-1}"
             )
+            continue
 
-            grindex = Room.Info.gridIndex(ex, ey, realWidth)
-            if grindex >= gridLen:
-                printf(
-                    f"Discarding the current entity stack due to invalid position! {room.getPrefix()}: {ex-1},{ey-1}"
-                )
-                continue
-
-            ents = room.gridSpawns[grindex]
-            for ent in stackedEnts:
-                entityXmlProps = dict(ent.attrib)
-                etype, evariant, esubtype, eweight = (
-                    int(ent.get("type")),
-                    int(ent.get("variant")),
-                    int(ent.get("subtype")),
-                    float(ent.get("weight")),
-                )
-                del entityXmlProps["type"]
-                del entityXmlProps["variant"]
-                del entityXmlProps["subtype"]
-                del entityXmlProps["weight"]
-                ents.append(
-                    Entity(ex, ey, etype, evariant, esubtype, eweight, entityXmlProps)
-                )
+        ents = []
+        for ent in stackedEnts:
+            entityXmlProps = dict(ent.attrib)
+            etype, evariant, esubtype, eweight = (
+                int(ent.get("type")),
+                int(ent.get("variant")),
+                int(ent.get("subtype")),
+                float(ent.get("weight")),
+            )
+            del entityXmlProps["type"]
+            del entityXmlProps["variant"]
+            del entityXmlProps["subtype"]
+            del entityXmlProps["weight"]
+            ents.append(
+                Entity(ex, ey, etype, evariant, esubtype, eweight, entityXmlProps)
+            )
+
+        room.addStack(grindex, ents)
+
+    return room
+
+
+def _iterXMLRoomNodes(path, fileXmlProps=None):
+    """
+    Incrementally parses an xml room file, yielding each top level room node as soon as
+    its end tag is read and then discarding it, so only one room is held at once.
+    If given, fileXmlProps is filled in with the root node's attributes
+    """
+    root = None
+    depth = 0
+    for event, node in ET.iterparse(path, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = node  # can be stage, rooms, etc
+                if fileXmlProps is not None:
+                    fileXmlProps.update(root.attrib)
+            depth += 1
+            continue
+
+        depth -= 1
+        if depth != 1:
+            continue
+
+        if node.tag == "room":
+            yield node
+
+        root.clear()
+
+
+def _xmlRoomHeader(roomNode):
+    return (int(roomNode.get("type") or "1"), int(roomNode.get("variant") or "0"))
+
+
+def _iterXMLRooms(path, fileXmlProps=None, rtype=None):
+    """Incrementally converts the rooms of an xml room file, optionally only those of one type"""
+    for roomNode in _iterXMLRoomNodes(path, fileXmlProps):
+        if rtype is None or _xmlRoomHeader(roomNode)[0] == rtype:
+            yield _xmlRoomToCommon(roomNode)
 
-            room.gridSpawns = room.gridSpawns
 
-    fileXmlProps = dict(root.attrib)
+def xmlToRoomIter(path, rtype=None):
+    """
+    Lazily yields the rooms of an Afterbirth xml one at a time. If rtype is given,
+    rooms of other types are skipped without being converted
+    """
+    return _iterXMLRooms(path, rtype=rtype)
+
+
+def xmlRoomHeaderIter(path):
+    """Lazily yields the (type, variant) of each room in an Afterbirth xml"""
+    for roomNode in _iterXMLRoomNodes(path):
+        yield _xmlRoomHeader(roomNode)
+
+
+def xmlFileProps(path):
+    """Reads only the root node attributes of an xml room file"""
+    for event, node in ET.iterparse(path, events=("start",)):
+        return dict(node.attrib)
+
+    return {}
+
+
+def xmlToCommon(path, destPath=None):
+    """Converts an Afterbirth xml to the common format"""
+    fileXmlProps = {}
+    ret = list(_iterXMLRooms(path, fileXmlProps))
+
     return File(ret, fileXmlProps)
 
 
 def stbABToXML(path, destPath=None):
     destPath = destPath or Path(path).with_suffix(".xml")
-    return commonToXML(destPath, stbABToCommon(path))
+    return commonToXML(destPath, stbABToRoomIter(path))
 
 
 def xmlToSTBAB(path, destPath=None):
@@ -739,6 +993,93 @@ def xmlToSTBAB(path, destPath=None):
     return commonToSTBAB(destPath, xmlToCommon(path))
 
 
+ROOM_CACHE_VERSION = 2
+
+
+def _roomToRecord(room):
+    """Flattens a room into plain lists, keeping everything the xml writer needs"""
+    info = room.info
+    stacks = [
+        (x, y, [(e.Type, e.Variant, e.Subtype, e.weight, e.xmlProps) for e in stack])
+        for stack, x, y in room.spawns()
+    ]
+    return (
+        room.name,
+        room.difficulty,
+        room.weight,
+        info.type,
+        info.variant,
+        info.subtype,
+        info.shape,
+        info.doors,
+        room.lastTestTime and room.lastTestTime.isoformat(),
+        room.xmlProps,
+        stacks,
+    )
+
+
+def _recordToRoom(record):
+    (
+        name,
+        difficulty,
+        weight,
+        rtype,
+        variant,
+        subtype,
+        shape,
+        doors,
+        lastTestTime,
+        xmlProps,
+        stacks,
+    ) = record
+
+    room = Room(name, None, difficulty, weight, rtype, variant, subtype, shape, doors)
+    room.lastTestTime = lastTestTime and datetime.datetime.fromisoformat(lastTestTime)
+    room.xmlProps = xmlProps
+
+    realWidth = room.info.dims[0]
+    for x, y, ents in stacks:
+        room.addStack(
+            Room.Info.gridIndex(x, y, realWidth), [Entity(x, y, *ent) for ent in ents]
+        )
+
+    return room
+
+
+def commonToRoomCache(path, file):
+    """
+    Saves a parsed room file as compact json that loads much faster than the xml it
+    came from, for caching parse results. Plain data only, so a planted cache file
+    can't run anything when loaded
+    """
+    records = [_roomToRecord(room) for room in file.rooms]
+    with _safeWrite(path, "w") as out:
+        json.dump(
+            [ROOM_CACHE_VERSION, file.xmlProps, records], out, separators=(",", ":")
+        )
+
+
+def roomCacheToCommon(path):
+    """Loads a room file saved by commonToRoomCache"""
+    with open(path) as f:
+        version, xmlProps, records = json.load(f)
+
+    if version != ROOM_CACHE_VERSION:
+        raise ValueError(f"Outdated room cache version {version}")
+
+    # the rooms hold no reference cycles, and collecting while creating this many
+    # objects otherwise takes longer than creating them
+    gcEnabled = gc.isenabled()
+    gc.disable()
+    try:
+        rooms = [_recordToRoom(record) for record in records]
+    finally:
+        if gcEnabled:
+            gc.enable()
+
+    return File(rooms, xmlProps)
+
+
 # HA HA HA FUNNY MODE FUNNY MODE
 def txtToCommon(path, entityLookup):
     """Convert a txt file to the common format"""
@@ -845,7 +1186,6 @@ def txtToCommon(path, entityLookup):
 
         r = Room(name, None, difficulty, weight, rtype, rvariant, rsubtype, shape)
         width, height = r.info.dims
-        spawns = r.gridSpawns
 
         i = skipWS(i + 2)
         for j in range(i, i + height):
@@ -869,13 +1209,13 @@ def txtToCommon(path, entityLookup):
 
                 ent = entMap.get(char)
                 if ent:
-                    spawns[Room.Info.gridIndex(x, y, width)].append(
-                        Entity(x, y, ent[0], ent[1], ent[2], 0)
+                    r.addStack(
+                        Room.Info.gridIndex(x, y, width),
+                        [Entity(x, y, ent[0], ent[1], ent[2], 0)],
                     )
                 else:
                     printf(f"Unknown entity! '{char}'")
 
-        r.gridSpawns = r.gridSpawns
         ret.append(r)
 
         i = skipWS(i + height)
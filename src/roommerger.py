@@ -3,14 +3,22 @@ Merges room files into one
 """
 
 from pathlib import Path
+from copy import copy
+from contextlib import ExitStack
 
-import subprocess
+import json, os, subprocess, threading
 import roomconvert as cvt
 
-from PyQt5.QtCore import QCommandLineOption, QCommandLineParser, QSettings
-from PyQt5.QtWidgets import QApplication
+from PyQt5.QtCore import (
+    QCommandLineOption,
+    QCommandLineParser,
+    QCoreApplication,
+    QSettings,
+    QStandardPaths,
+)
 
-from util import printf
+from core import File
+from util import hashFile, printf
 
 
 def recomputeRoomIDs(roomList, startingId=None):
@@ -30,77 +38,229 @@ def recomputeRoomIDs(roomList, startingId=None):
         roomsByType[room.info.type] += 1
 
 
-def runmain():
-    import sys
-
-    app = QApplication(sys.argv)
-
-    cmdParser = QCommandLineParser()
-    cmdParser.setApplicationDescription(
-        "Room file merger utility script for Basement Renovator. Takes a set of file paths"
-    )
-    cmdParser.addHelpOption()
-
-    cmdParser.addPositionalArgument("file", "xml files to merge")
-
-    outputFileOpt = QCommandLineOption("output", "output filename, must be xml", "file")
-    cmdParser.addOption(outputFileOpt)
-
-    stbOpt = QCommandLineOption(
-        "stb", "whether to save an stb version of the file next to it"
-    )
-    cmdParser.addOption(stbOpt)
-
-    noRecompIdsOpt = QCommandLineOption(
-        "noRecomputeIds",
-        "turn off recomputing room ids; useful for special room merging",
-    )
-    cmdParser.addOption(noRecompIdsOpt)
-
-    idOpt = QCommandLineOption(
-        "startingId", "optional starting id to use when recomputing room ids", "id"
-    )
-    cmdParser.addOption(idOpt)
-
-    skipOpt = QCommandLineOption(
-        "roommerge", "placeholder argument used to prevent recursive execution"
-    )
-    cmdParser.addOption(skipOpt)
-
-    cmdParser.process(app)
+# a disposable per user cache, kept out of the editor's folder so it never grows inside it
+DEFAULT_CACHE_DIR = (
+    Path(QStandardPaths.writableLocation(QStandardPaths.GenericCacheLocation))
+    / "BasementRenovator"
+    / "RoomCache"
+)
+
+
+class RoomFileCache:
+    """
+    Shares parsed room files between merges, so a file that several merges read is
+    only parsed once. Safe to use from multiple threads. With a cache folder, parse
+    results are also kept on disk keyed by file content, so later merges only parse
+    the files that changed. Only the newest version of each input is kept there
+    """
+
+    INDEX_VERSION = 1
+
+    def __init__(self, cacheDir=None):
+        self.files = {}
+        self.lock = threading.Lock()
+        self.pathLocks = {}
+        self.cacheDir = cacheDir and Path(cacheDir)
+        # input path -> content hash of the version cached for it
+        self.index = None
+
+    def _loadIndex(self):
+        self.index = {}
+
+        # someone else's folder could hold anything, don't read from or write to it
+        try:
+            self.cacheDir.mkdir(mode=0o700, parents=True, exist_ok=True)
+            if hasattr(os, "getuid") and self.cacheDir.stat().st_uid != os.getuid():
+                printf(
+                    "Not using room cache",
+                    self.cacheDir,
+                    "since it's owned by another user",
+                )
+                self.cacheDir = None
+                return
+        except OSError as e:
+            printf("Not using room cache", self.cacheDir, "Reason:", e)
+            self.cacheDir = None
+            return
 
-    if cmdParser.isSet(skipOpt):
-        printf("Recursive execution from save hook, skipping")
-        return
+        indexPath = self.cacheDir / "index.json"
+        if indexPath.exists():
+            try:
+                with open(indexPath) as f:
+                    index = json.load(f)
+
+                if index.get("version") == RoomFileCache.INDEX_VERSION:
+                    self.index = index["files"]
+            except (OSError, ValueError, KeyError) as e:
+                printf("Ignoring unreadable room cache index", indexPath, e)
+
+        # inputs that are gone won't be read again, and anything else in the folder
+        # is left over from older versions of inputs
+        index = {
+            path: digest for path, digest in self.index.items() if os.path.isfile(path)
+        }
+        kept = set(index.values())
+        for cachePath in self.cacheDir.glob("*.rooms"):
+            if cachePath.stem not in kept:
+                self._remove(cachePath)
+
+        if index != self.index:
+            self.index = index
+            self._saveIndex()
+
+    def _saveIndex(self):
+        indexPath = self.cacheDir / "index.json"
+        tempPath = self.cacheDir / "index.json.tmp"
+        try:
+            with open(tempPath, "w") as f:
+                json.dump(
+                    {"version": RoomFileCache.INDEX_VERSION, "files": self.index},
+                    f,
+                    indent=4,
+                )
+            os.replace(tempPath, indexPath)
+        except OSError as e:
+            printf("Could not save room cache index", indexPath, e)
+
+    @staticmethod
+    def _remove(cachePath):
+        try:
+            cachePath.unlink()
+        except OSError as e:
+            printf("Could not remove stale room cache", cachePath, "Reason:", e)
+
+    def _record(self, path, digest):
+        """Points the index at the newest version of an input, dropping the one it replaced"""
+        with self.lock:
+            key = str(path.resolve())
+            previous = self.index.get(key)
+            if previous == digest:
+                return
+
+            self.index[key] = digest
+            if previous is not None and previous not in self.index.values():
+                self._remove(self.cacheDir / (previous + ".rooms"))
+
+            self._saveIndex()
+
+    def _load(self, path):
+        # pruning has to happen before anything new is written to the folder
+        if self.cacheDir:
+            with self.lock:
+                if self.index is None:
+                    self._loadIndex()
+
+        if not self.cacheDir:
+            return cvt.xmlToCommon(path)
+
+        digest = hashFile(path)
+        cachePath = self.cacheDir / (digest + ".rooms")
+        roomFile = None
+        if cachePath.exists():
+            try:
+                roomFile = cvt.roomCacheToCommon(cachePath)
+            except Exception as e:
+                printf("Ignoring unreadable room cache", cachePath, "Reason:", e)
 
-    paths = cmdParser.positionalArguments()
-    if not paths:
-        printf("Must specify at least one file to merge!")
+        if roomFile is None:
+            roomFile = cvt.xmlToCommon(path)
+            try:
+                cvt.commonToRoomCache(cachePath, roomFile)
+            except OSError as e:
+                printf("Could not save room cache", cachePath, "Reason:", e)
+                return roomFile
+
+        self._record(path, digest)
+        return roomFile
+
+    def get(self, path):
+        """Returns the parsed room file, with rooms that are safe to renumber"""
+        stat = path.stat()
+        key = (str(path.resolve()), stat.st_size, stat.st_mtime_ns)
+
+        with self.lock:
+            pathLock = self.pathLocks.setdefault(key, threading.Lock())
+
+        with pathLock:
+            roomFile = self.files.get(key)
+            if roomFile is None:
+                roomFile = self.files[key] = self._load(path)
+
+        # merging only changes room ids, so the spawns can be shared
+        rooms = []
+        for room in roomFile.rooms:
+            room = copy(room)
+            room.info = copy(room.info)
+            rooms.append(room)
+
+        return File(rooms, dict(roomFile.xmlProps))
+
+
+def streamMergedRooms(paths, noRecomputeIds=False, startingId=None):
+    """
+    Lazily yields the merged rooms of the given xml files, in the same order and with
+    the same ids as recomputeRoomIDs would give them, holding only one room at a time.
+    Recomputing ids takes a first pass over only the room types and variants, then
+    reads the files again once per room type
+    """
+    if noRecomputeIds:
+        for path in paths:
+            yield from cvt.xmlToRoomIter(path)
         return
 
-    outputFileArg = cmdParser.value(outputFileOpt)
-    outputFilePath = Path(outputFileArg).absolute().resolve()
-    if not outputFileArg or outputFilePath.suffix != ".xml":
+    firstVariants = {}
+    pathTypes = []
+    for path in paths:
+        types = set()
+        for rtype, variant in cvt.xmlRoomHeaderIter(path):
+            firstVariants.setdefault(rtype, variant)
+            types.add(rtype)
+        pathTypes.append(types)
+
+    # rooms are sorted by type, keeping file order within a type
+    for rtype in sorted(firstVariants):
+        variant = startingId or firstVariants[rtype]
+        for path, types in zip(paths, pathTypes):
+            if rtype not in types:
+                continue
+
+            for room in cvt.xmlToRoomIter(path, rtype):
+                room.info.variant = variant
+                variant += 1
+                yield room
+
+
+def mergeRoomFiles(
+    paths,
+    outputFilePath,
+    stb=False,
+    noRecomputeIds=False,
+    startingId=None,
+    fileCache=None,
+    stream=False,
+):
+    """
+    Merges xml room files and folders of them into one xml, optionally with an stb
+    next to it, and runs the save hooks on the result. Returns whether anything was merged.
+    With stream, rooms are piped from the inputs to the outputs one at a time rather
+    than loading every input first
+    """
+    outputFilePath = Path(outputFilePath).absolute().resolve()
+    if outputFilePath.suffix != ".xml":
         printf("Must specify xml output file!")
-        return
+        return False
 
     lastModified = None
     if outputFilePath.exists():
         lastModified = outputFilePath.stat().st_mtime
 
-    idArg = cmdParser.value(idOpt)
-
-    noRecompIdsArg = cmdParser.isSet(noRecompIdsOpt)
-    stbArg = cmdParser.isSet(stbOpt)
+    paths = list(map(Path, paths))
 
-    mergeRoomFile = None
     i = -1
     while (i + 1) < len(paths):
         i += 1
 
-        file = paths[i]
-
-        path = Path(file)
+        path = paths[i]
         if path.is_dir():
             files = list(filter(lambda f: f.suffix == ".xml", path.iterdir()))
             printf("Adding xml files to queue from: ", path)
@@ -108,7 +268,7 @@ def runmain():
             i -= 1
             paths.extend(files)
 
-    paths = list(filter(lambda f: Path(f).exists(), paths))
+    paths = list(filter(lambda f: f.exists(), paths))
 
     if lastModified:
         anyModified = (
@@ -120,37 +280,72 @@ def runmain():
             printf(
                 "Skipping since no xmls in folder have been modified since last update"
             )
-            return
+            return False
+
+    if stream:
+        xmlPaths = []
+        for path in paths:
+            printf("----")
+            printf("Path:", path)
+
+            if path.suffix != ".xml":
+                printf("Must be xml! Skipping!")
+                continue
+
+            xmlPaths.append(path)
 
-    for file in paths:
         printf("----")
-        printf("Path:", file)
 
-        path = Path(file)
+        if not xmlPaths:
+            printf("No rooms files to merge")
+            return False
+
+        mergeRoomFile = File([], cvt.xmlFileProps(xmlPaths[0]))
+        rooms = streamMergedRooms(xmlPaths, noRecomputeIds, startingId)
+    else:
+        fileCache = fileCache or RoomFileCache()
+
+        mergeRoomFile = None
+        for path in paths:
+            printf("----")
+            printf("Path:", path)
+
+            printf("Merging file...")
+            if path.suffix != ".xml":
+                printf("Must be xml! Skipping!")
+                continue
 
-        printf("Merging file...")
-        if path.suffix != ".xml":
-            printf("Must be xml! Skipping!")
-            continue
+            roomFile = fileCache.get(path)
+
+            if not mergeRoomFile:
+                mergeRoomFile = roomFile
+            else:
+                mergeRoomFile.rooms.extend(roomFile.rooms)
+
+        printf("----")
 
-        roomFile = cvt.xmlToCommon(path)
         if not mergeRoomFile:
-            mergeRoomFile = roomFile
-        else:
-            mergeRoomFile.rooms.extend(roomFile.rooms)
+            printf("No rooms files to merge")
+            return False
 
-    printf("----")
+        if not noRecomputeIds:
+            recomputeRoomIDs(mergeRoomFile.rooms, startingId)
 
-    if not mergeRoomFile:
-        printf("No rooms files to merge")
-        return
+        rooms = mergeRoomFile.rooms
 
-    if not noRecompIdsArg:
-        recomputeRoomIDs(mergeRoomFile.rooms, idArg and int(idArg))
+    # both outputs are written in the same pass, so streamed rooms are only read once
+    with ExitStack() as outputs:
+        writeXML = outputs.enter_context(
+            cvt.xmlRoomWriter(outputFilePath, mergeRoomFile)
+        )
+        writeSTB = stb and outputs.enter_context(
+            cvt.stbRoomWriter(outputFilePath.with_suffix(".stb"))
+        )
 
-    cvt.commonToXML(outputFilePath, mergeRoomFile.rooms, file=mergeRoomFile)
-    if stbArg:
-        cvt.commonToSTBAB(outputFileArg.replace(".xml", ".stb"), mergeRoomFile.rooms)
+        for room in rooms:
+            writeXML(room)
+            if writeSTB:
+                writeSTB(room)
 
     settings = QSettings(__file__ + "/../../settings.ini", QSettings.IniFormat)
     saveHooks = settings.value("HooksSave")
@@ -167,7 +362,94 @@ def runmain():
             except Exception as e:
                 printf("Save hook failed! Reason:", e)
 
-    printf("Success! Merged to", outputFileArg)
+    printf("Success! Merged to", outputFilePath)
+    return True
+
+
+def runmain():
+    import sys
+
+    app = QCoreApplication(sys.argv)
+
+    cmdParser = QCommandLineParser()
+    cmdParser.setApplicationDescription(
+        "Room file merger utility script for Basement Renovator. Takes a set of file paths"
+    )
+    cmdParser.addHelpOption()
+
+    cmdParser.addPositionalArgument("file", "xml files to merge")
+
+    outputFileOpt = QCommandLineOption("output", "output filename, must be xml", "file")
+    cmdParser.addOption(outputFileOpt)
+
+    stbOpt = QCommandLineOption(
+        "stb", "whether to save an stb version of the file next to it"
+    )
+    cmdParser.addOption(stbOpt)
+
+    noRecompIdsOpt = QCommandLineOption(
+        "noRecomputeIds",
+        "turn off recomputing room ids; useful for special room merging",
+    )
+    cmdParser.addOption(noRecompIdsOpt)
+
+    idOpt = QCommandLineOption(
+        "startingId", "optional starting id to use when recomputing room ids", "id"
+    )
+    cmdParser.addOption(idOpt)
+
+    cacheOpt = QCommandLineOption(
+        "cache",
+        f"folder to keep parsed input files in so unchanged inputs are not parsed again, defaults to {DEFAULT_CACHE_DIR}",
+        "folder",
+    )
+    cmdParser.addOption(cacheOpt)
+
+    noCacheOpt = QCommandLineOption("noCache", "turn off the parsed input cache")
+    cmdParser.addOption(noCacheOpt)
+
+    streamOpt = QCommandLineOption(
+        "stream",
+        "merge one room at a time instead of loading every input first; uses little memory but skips the parsed input cache",
+    )
+    cmdParser.addOption(streamOpt)
+
+    skipOpt = QCommandLineOption(
+        "roommerge", "placeholder argument used to prevent recursive execution"
+    )
+    cmdParser.addOption(skipOpt)
+
+    cmdParser.process(app)
+
+    if cmdParser.isSet(skipOpt):
+        printf("Recursive execution from save hook, skipping")
+        return
+
+    paths = cmdParser.positionalArguments()
+    if not paths:
+        printf("Must specify at least one file to merge!")
+        return
+
+    outputFileArg = cmdParser.value(outputFileOpt)
+    if not outputFileArg:
+        printf("Must specify xml output file!")
+        return
+
+    idArg = cmdParser.value(idOpt)
+
+    cacheDir = None
+    if not cmdParser.isSet(noCacheOpt):
+        cacheDir = cmdParser.value(cacheOpt) or DEFAULT_CACHE_DIR
+
+    mergeRoomFiles(
+        paths,
+        outputFileArg,
+        stb=cmdParser.isSet(stbOpt),
+        noRecomputeIds=cmdParser.isSet(noRecompIdsOpt),
+        startingId=idArg and int(idArg),
+        fileCache=RoomFileCache(cacheDir),
+        stream=cmdParser.isSet(streamOpt),
+    )
 
 
 if __name__ == "__main__":
@@ -4,53 +4,106 @@ Merges room files into one specified by a config file
 
 from pathlib import Path
 
-import subprocess, json
+import json
+from concurrent.futures import ThreadPoolExecutor
 
-from PyQt5.QtCore import QCommandLineOption, QCommandLineParser
-from PyQt5.QtWidgets import QApplication
+from PyQt5.QtCore import QCommandLineOption, QCommandLineParser, QCoreApplication
 
-from util import printf
+from roommerger import DEFAULT_CACHE_DIR, RoomFileCache, mergeRoomFiles
+from util import bufferedPrintf, printf
 
 
-def mergeRooms(configList, scriptPath, cwd, fileEdited=None):
-    printf("Script path:", scriptPath)
-    for config in configList:
-        if fileEdited:
-            skipConfig = True
-            for path in config["paths"]:
-                path = (cwd / path).absolute().resolve()
-                if (path.is_dir() and fileEdited.parent == path) or path == fileEdited:
-                    skipConfig = False
-                    break
+def _configInputs(config, cwd):
+    return [(cwd / path).absolute().resolve() for path in config["paths"]]
 
-            if skipConfig:
-                continue
 
-        printf("Current config:", config)
+def _configOutput(config, cwd):
+    return (cwd / config["outputFile"]).absolute().resolve()
+
+
+def _configReads(config, cwd, path):
+    """Whether the config merges the given file, directly or through its folder"""
+    for inputPath in _configInputs(config, cwd):
+        if (inputPath.is_dir() and path.parent == inputPath) or path == inputPath:
+            return True
+    return False
 
-        args = (
-            ["python", scriptPath, "--output", config["outputFile"]]
-            + config["paths"]
-            + (["--stb"] if not config.get("skipSTB") else [])
-            + (["--noRecomputeIds"] if config.get("noRecomputeIds") else [])
-            + (
-                []
-                if not config.get("startingId")
-                else ["--startingId", str(config["startingId"])]
+
+def _configWaves(configList, cwd):
+    """
+    Splits configs into groups that can merge concurrently; a config that reads
+    another config's output is placed in a later group, otherwise config order is kept
+    """
+    waves = []
+    remaining = list(configList)
+    while remaining:
+        wave = [
+            config
+            for config in remaining
+            if not any(
+                other is not config
+                and _configReads(config, cwd, _configOutput(other, cwd))
+                for other in remaining
             )
-        )
+        ]
+        # circular configs, fall back to running them one at a time in order
+        if not wave:
+            wave = remaining[:1]
+
+        waves.append(wave)
+        remaining = [config for config in remaining if config not in wave]
+
+    return waves
+
+
+def _mergeConfig(config, cwd, fileCache):
+    # configs in a wave merge concurrently, each one's log is printed once it's done
+    with bufferedPrintf():
+        printf("Current config:", config)
+        try:
+            mergeRoomFiles(
+                _configInputs(config, cwd),
+                _configOutput(config, cwd),
+                stb=not config.get("skipSTB"),
+                noRecomputeIds=config.get("noRecomputeIds"),
+                startingId=config.get("startingId") and int(config["startingId"]),
+                fileCache=fileCache,
+                stream=config.get("stream"),
+            )
+        except Exception as e:
+            printf("Merging", config["outputFile"], "failed! Reason:", e)
+
+
+def mergeRooms(configList, cwd, fileEdited=None, jobs=None, cacheDir=None):
+    """
+    Merges every config in the list in this process, sharing parsed room files
+    between them. Independent configs are merged concurrently on up to jobs threads,
+    which overlaps their file reads and writes, but parsing and converting rooms is
+    pure Python and so still runs one config at a time
+    """
+    if fileEdited:
+        configList = [
+            config for config in configList if _configReads(config, cwd, fileEdited)
+        ]
 
-        subprocess.run(args, cwd=cwd)
+    fileCache = RoomFileCache(cacheDir)
+    for wave in _configWaves(configList, cwd):
+        with ThreadPoolExecutor(max_workers=jobs or len(wave)) as executor:
+            futures = [
+                executor.submit(_mergeConfig, config, cwd, fileCache) for config in wave
+            ]
+            for future in futures:
+                future.result()
 
 
 def runmain():
     import sys
 
-    app = QApplication(sys.argv)
+    app = QCoreApplication(sys.argv)
 
     cmdParser = QCommandLineParser()
     cmdParser.setApplicationDescription(
-        "Room file merger utility script for Basement Renovator. Takes a config file and feeds it to the cli roommerger script"
+        "Room file merger utility script for Basement Renovator. Takes a config file and merges each entry with the roommerger script"
     )
     cmdParser.addHelpOption()
 
@@ -64,7 +117,8 @@ def runmain():
                 paths: [ path to file/folder to replace, ... ],
                 skipSTB: optional, true to skip generating the stb,
                 noRecomputeIds: optional, true to skip recompute room ids,
-                startingId: starting room id to recompute from
+                startingId: starting room id to recompute from,
+                stream: optional, true to merge one room at a time to save memory
             }...
         ]
     }
@@ -78,6 +132,23 @@ def runmain():
     )
     cmdParser.addOption(fileEditedOpt)
 
+    jobsOpt = QCommandLineOption(
+        "jobs",
+        "maximum number of configs to merge at once on threads, defaults to one per config; only file access overlaps, room parsing and conversion still run one at a time",
+        "n",
+    )
+    cmdParser.addOption(jobsOpt)
+
+    cacheOpt = QCommandLineOption(
+        "cache",
+        f"folder to keep parsed input files in so unchanged inputs are not parsed again, defaults to {DEFAULT_CACHE_DIR}",
+        "folder",
+    )
+    cmdParser.addOption(cacheOpt)
+
+    noCacheOpt = QCommandLineOption("noCache", "turn off the parsed input cache")
+    cmdParser.addOption(noCacheOpt)
+
     cmdParser.process(app)
 
     configArg = cmdParser.positionalArguments()[0]
@@ -94,16 +165,24 @@ def runmain():
             printf("Invalid edited file path!")
             return
 
-    scriptPath = Path(__file__ + "/../roommerger.py").absolute().resolve()
+    jobsArg = cmdParser.value(jobsOpt)
+    if jobsArg and (not jobsArg.isdigit() or int(jobsArg) < 1):
+        printf("Invalid number of jobs!")
+        return
+
+    cacheDir = None
+    if not cmdParser.isSet(noCacheOpt):
+        cacheDir = cmdParser.value(cacheOpt) or DEFAULT_CACHE_DIR
 
     with open(configPath) as configFile:
         config = json.load(configFile)
 
         mergeRooms(
             config["files"],
-            str(scriptPath),
             configPath.parent,
             fileEdited=fileEditedPath,
+            jobs=jobsArg and int(jobsArg) or None,
+            cacheDir=cacheDir,
         )
 
     printf("Success! Merged all.")
@@ -12,9 +12,15 @@ from PyQt5.QtWidgets import QApplication
 from util import printf
 
 
-def convertRooms(configList, scriptPath, cwd, fileEdited=None):
+def convertRooms(
+    configList, scriptPath, cwd, fileEdited=None, manifestPath=None, force=False
+):
     printf("Script path:", scriptPath)
     for config in configList:
+        # entries can be a plain file/folder, or an object with a list of paths
+        if not isinstance(config, dict):
+            config = {"paths": [config]}
+
         if fileEdited:
             skipConfig = True
             for path in config["paths"]:
@@ -28,7 +34,12 @@ def convertRooms(configList, scriptPath, cwd, fileEdited=None):
 
         printf("Current config:", config)
 
-        args = ["python", scriptPath] + config["paths"]
+        args = (
+            ["python", scriptPath]
+            + config["paths"]
+            + (["--manifest", str(manifestPath)] if manifestPath else [])
+            + (["--force"] if force else [])
+        )
 
         subprocess.run(args, cwd=cwd)
 
@@ -40,7 +51,7 @@ def runmain():
 
     cmdParser = QCommandLineParser()
     cmdParser.setApplicationDescription(
-        "Room file converter utility script for Basement Renovator. Takes a config file and feeds it to the cli roombulkconverter script"
+        "Room file converter utility script for Basement Renovator. Takes a config file and feeds it to the cli stb-bulk-converter script"
     )
     cmdParser.addHelpOption()
 
@@ -60,6 +71,12 @@ def runmain():
     )
     cmdParser.addOption(fileEditedOpt)
 
+    forceOpt = QCommandLineOption(
+        "force",
+        "convert every file, even ones that haven't changed since they were last converted",
+    )
+    cmdParser.addOption(forceOpt)
+
     cmdParser.process(app)
 
     configArg = cmdParser.positionalArguments()[0]
@@ -76,7 +93,10 @@ def runmain():
             printf("Invalid edited file path!")
             return
 
-    scriptPath = Path(__file__ + "/../roombulkconverter.py").absolute().resolve()
+    scriptPath = Path(__file__ + "/../stb-bulk-converter.py").absolute().resolve()
+
+    # conversions are remembered next to the config, so unchanged files are skipped
+    manifestPath = configPath.with_name(configPath.stem + ".manifest.json")
 
     with open(configPath) as configFile:
         config = json.load(configFile)
@@ -86,6 +106,8 @@ def runmain():
             str(scriptPath),
             configPath.parent,
             fileEdited=fileEditedPath,
+            manifestPath=manifestPath,
+            force=cmdParser.isSet(forceOpt),
         )
 
     printf("Success! Merged all.")
@@ -6,16 +6,37 @@ from pathlib import Path
 
 import roomconvert as cvt
 
-from PyQt5.QtCore import QCommandLineOption, QCommandLineParser, QSettings
-from PyQt5.QtWidgets import QApplication
+from PyQt5.QtCore import QCommandLineOption, QCommandLineParser, QCoreApplication
 
-from util import printf
+from util import printf, runJobs, ConversionManifest
+
+# conversions are remembered next to the files, unless --manifest says otherwise
+MANIFEST_NAME = "stb-bulk-converter.manifest.json"
+
+
+def convertFile(path, doSortEnts):
+    """Converts a single stb file to an xml next to it, returning the room count"""
+    numRooms = 0
+
+    def rooms():
+        nonlocal numRooms
+        for room in cvt.stbToRoomIter(path):
+            if doSortEnts:
+                for stack, x, y in room.spawns():
+                    stack.sort(key=lambda ent: (ent.Type, ent.Variant, ent.Subtype))
+
+            numRooms += 1
+            yield room
+
+    cvt.commonToXML(path.with_suffix(".xml"), rooms())
+
+    return numRooms
 
 
 def runmain():
     import sys
 
-    app = QApplication(sys.argv)
+    app = QCoreApplication(sys.argv)
 
     cmdParser = QCommandLineParser()
     cmdParser.setApplicationDescription(
@@ -31,6 +52,27 @@ def runmain():
     )
     cmdParser.addOption(sortEntsOpt)
 
+    jobsOpt = QCommandLineOption(
+        "jobs",
+        "number of processes to convert files with; 0 uses one per core",
+        "n",
+        "1",
+    )
+    cmdParser.addOption(jobsOpt)
+
+    manifestOpt = QCommandLineOption(
+        "manifest",
+        "file remembering previous conversions, so files that haven't changed since are skipped;"
+        f" defaults to {MANIFEST_NAME} in each converted file's folder",
+        "file",
+    )
+    cmdParser.addOption(manifestOpt)
+
+    forceOpt = QCommandLineOption(
+        "force", "convert every file, even ones the manifest says are unchanged"
+    )
+    cmdParser.addOption(forceOpt)
+
     skipOpt = QCommandLineOption(
         "roomconvert", "placeholder argument used to prevent recursive execution"
     )
@@ -49,6 +91,12 @@ def runmain():
 
     doSortEnts = cmdParser.isSet(sortEntsOpt)
 
+    jobsArg = cmdParser.value(jobsOpt)
+    if not jobsArg.isdigit():
+        printf("Jobs must be a whole number!")
+        return
+    jobs = int(jobsArg)
+
     i = -1
     while (i + 1) < len(paths):
         i += 1
@@ -57,7 +105,7 @@ def runmain():
 
         path = Path(file)
         if path.is_dir():
-            files = list(filter(lambda f: f.suffix == ".stb", path.iterdir()))
+            files = sorted(filter(lambda f: f.suffix == ".stb", path.iterdir()))
             printf("Adding stb files to queue from: ", path)
             del paths[i]
             i -= 1
@@ -65,28 +113,54 @@ def runmain():
 
     paths = list(filter(lambda f: Path(f).exists(), paths))
 
-    for file in paths:
-        printf("----")
-        printf("Converting path:", file)
+    manifestArg = cmdParser.value(manifestOpt)
+    manifests = {}
+
+    def manifestFor(path):
+        manifestPath = manifestArg or str(path.parent / MANIFEST_NAME)
+        if manifestPath not in manifests:
+            manifests[manifestPath] = ConversionManifest(manifestPath)
+        return manifests[manifestPath]
+
+    doForce = cmdParser.isSet(forceOpt)
+    convertOptions = doSortEnts and "sortEntities" or ""
 
+    toConvert = []
+    for file in paths:
         path = Path(file)
 
         if path.suffix != ".stb":
-            printf("Must be stb! Skipping!")
+            printf("----")
+            printf("Must be stb! Skipping:", path)
             continue
 
-        outputFilePath = path.with_suffix(".xml")
-        roomFile = cvt.stbToCommon(path)
+        if not doForce and manifestFor(path).isUpToDate(
+            path, path.with_suffix(".xml"), convertOptions
+        ):
+            printf("----")
+            printf("Skipping unchanged path:", path)
+            continue
 
-        if doSortEnts:
-            for room in roomFile.rooms:
-                for stack, x, y in room.spawns():
-                    stack.sort(key=lambda ent: (ent.Type, ent.Variant, ent.Subtype))
+        toConvert.append(path)
+
+    results = runJobs(convertFile, [(path, doSortEnts) for path in toConvert], jobs)
+
+    failed = 0
+    for path, (numRooms, error) in zip(toConvert, results):
+        printf("----")
+        if error:
+            failed += 1
+            printf("Failed converting path:", path)
+            printf("Reason:", repr(error))
+        else:
+            printf(f"Converted path: {path} ({numRooms} rooms)")
+            manifestFor(path).update(path, path.with_suffix(".xml"), convertOptions)
 
-        cvt.commonToXML(outputFilePath, roomFile.rooms, file=roomFile)
+    for manifest in manifests.values():
+        manifest.save()
 
     printf("----")
-    printf("Done!")
+    printf(f"Done! Converted {len(toConvert) - failed} files, {failed} failed")
 
 
 if __name__ == "__main__":
@@ -1,15 +1,169 @@
 import os
+import stat
 import math
+import json
+import hashlib
+import io
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+# per thread buffer printf writes to instead of stdout, see bufferedPrintf
+_printBuffer = threading.local()
+_printLock = threading.Lock()
 
 
 def printf(*args):
+    buffer = getattr(_printBuffer, "buffer", None)
+    if buffer is not None:
+        print(*args, file=buffer)
+        return
+
     print(*args, flush=True)
 
 
+@contextmanager
+def bufferedPrintf():
+    """
+    Holds back what printf prints on this thread until the block exits, then prints
+    it in one piece, so concurrent jobs' logs don't interleave
+    """
+    if getattr(_printBuffer, "buffer", None) is not None:
+        yield
+        return
+
+    _printBuffer.buffer = io.StringIO()
+    try:
+        yield
+    finally:
+        output = _printBuffer.buffer.getvalue()
+        _printBuffer.buffer = None
+        with _printLock:
+            print(output, end="", flush=True)
+
+
 def printSectionBreak():
     printf("-".join(["" for i in range(50)]))
 
 
+def runJobs(func, argsList, jobs=1):
+    """
+    Calls func with each tuple of args, spread over a pool of processes when jobs is
+    more than 1 (0 uses one per core). Returns a (result, error) pair per call in the
+    same order as argsList, so a failing call doesn't stop the others
+    """
+    results = []
+    if jobs == 1:
+        for args in argsList:
+            try:
+                results.append((func(*args), None))
+            except Exception as e:
+                results.append((None, e))
+
+        return results
+
+    with ProcessPoolExecutor(max_workers=jobs or None) as pool:
+        futures = [pool.submit(func, *args) for args in argsList]
+        for future in futures:
+            try:
+                results.append((future.result(), None))
+            except Exception as e:
+                results.append((None, e))
+
+    return results
+
+
+def hashFile(path):
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+class ConversionManifest:
+    """
+    Persists the size, mtime and content hash of every converted file along with the
+    hash of what it was converted to, so conversions whose input and output are both
+    unchanged since the last run can be skipped
+    """
+
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+
+        if os.path.isfile(path):
+            try:
+                with open(path) as f:
+                    manifest = json.load(f)
+
+                if manifest.get("version") == ConversionManifest.VERSION:
+                    self.entries = manifest["files"]
+            except (OSError, ValueError, KeyError) as e:
+                printf("Ignoring unreadable conversion manifest", path, e)
+
+    @staticmethod
+    def _fileState(path, knownState=None):
+        # hashing is skipped when the size and mtime already match
+        stat = os.stat(path)
+        if (
+            knownState
+            and knownState["size"] == stat.st_size
+            and knownState["mtime"] == stat.st_mtime_ns
+        ):
+            return knownState
+
+        return {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "hash": hashFile(path),
+        }
+
+    def isUpToDate(self, inputPath, outputPath, options=""):
+        entry = self.entries.get(os.path.abspath(inputPath))
+        if (
+            not entry
+            or entry["options"] != options
+            or entry["output"] != os.path.abspath(outputPath)
+            or not os.path.isfile(outputPath)
+        ):
+            return False
+
+        inputState = self._fileState(inputPath, entry["input"])
+        outputState = self._fileState(outputPath, entry["outputState"])
+        if (
+            inputState["hash"] != entry["input"]["hash"]
+            or outputState["hash"] != entry["outputState"]["hash"]
+        ):
+            return False
+
+        # files that were only touched won't need hashing next time
+        entry["input"] = inputState
+        entry["outputState"] = outputState
+        return True
+
+    def update(self, inputPath, outputPath, options=""):
+        self.entries[os.path.abspath(inputPath)] = {
+            "options": options,
+            "input": self._fileState(inputPath),
+            "output": os.path.abspath(outputPath),
+            "outputState": self._fileState(outputPath),
+        }
+
+    def save(self):
+        # written aside and swapped in, so an interrupted save keeps the old manifest
+        tempPath = f"{self.path}.tmp"
+        try:
+            with open(tempPath, "w") as f:
+                json.dump(
+                    {"version": ConversionManifest.VERSION, "files": self.entries},
+                    f,
+                    indent=4,
+                )
+            os.replace(tempPath, self.path)
+        except OSError as e:
+            printf("Could not save conversion manifest", self.path, e)
+
+
 def bitFill(count):
     return (1 << count) - 1
 
@@ -26,19 +180,74 @@ def bitSet(bits, sourceBits, startBit, count):
     return bits | sourceBits
 
 
+# directory -> (mtime, {case folded name: actual name})
+_directoryListings = {}
+
+# folders paths have been resolved in, a subset of the listed ones
+_usedDirectories = set()
+
+
+def _getDirectoryListing(directory):
+    """
+    Returns a directory's case folded listing, reading it again only when the
+    directory's mtime has changed, or None if it isn't a directory
+    """
+    try:
+        dirStat = os.stat(directory)
+    except OSError:
+        return None
+
+    if not stat.S_ISDIR(dirStat.st_mode):
+        return None
+
+    cached = _directoryListings.get(directory)
+    if cached and cached[0] == dirStat.st_mtime_ns:
+        return cached[1]
+
+    listing = {}
+    for item in os.listdir(directory):
+        listing.setdefault(item.lower(), item)
+
+    _directoryListings[directory] = (dirStat.st_mtime_ns, listing)
+    return listing
+
+
+def prewarmDirectoryListings(root):
+    """
+    Caches the listing of a folder and every folder under it up front, for folders
+    many paths are about to be resolved in
+    """
+    root = os.path.normpath(root)
+    for directory, dirs, files in os.walk(root):
+        _getDirectoryListing(directory)
+
+
+def usedDirectories():
+    """
+    Returns every folder linuxPathSensitivityTraining has resolved a path in,
+    whether or not it exists
+    """
+    return list(_usedDirectories)
+
+
+def clearDirectoryListings():
+    _directoryListings.clear()
+    _usedDirectories.clear()
+
+
 def linuxPathSensitivityTraining(path):
     path = path.replace("\\", "/")
 
     directory, file = os.path.split(os.path.normpath(path))
 
-    if not os.path.isdir(directory):
+    _usedDirectories.add(directory)
+    listing = _getDirectoryListing(directory)
+    if listing is None:
         return None
 
-    contents = os.listdir(directory)
-
-    for item in contents:
-        if item.lower() == file.lower():
-            return os.path.normpath(os.path.join(directory, item))
+    item = listing.get(file.lower())
+    if item is not None:
+        return os.path.normpath(os.path.join(directory, item))
 
     return os.path.normpath(path)
 